@@ -0,0 +1,203 @@
+"""Benchmark harness for the GreenPath routing and training hot paths.
+
+Sweeps grid sizes and episode counts, timing each component in-process and
+reporting latency percentiles, throughput and peak traced memory. Results are
+written as JSON so runs from different versions can be compared:
+
+    python benchmark.py --sizes 8 16 32 --episodes 200 1000 --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+import main
+
+
+def measure(fn: Callable[[], object], repeats: int, warmup: int = 1) -> dict:
+    """Times `fn` over `repeats` calls; peak memory is traced over one extra call."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ms = np.array(samples)
+    return {
+        "repeats": repeats,
+        "mean_ms": round(float(ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(ms, 99)), 4),
+        "throughput_per_s": round(1000 / float(ms.mean()), 2) if ms.mean() > 0 else None,
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
+
+
+def seed_all(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def build_world(size: int, seed: int):
+    seed_all(seed)
+    graph = main.CityGraph(size)
+    env = main.Environment(graph)
+    env.rng = np.random.default_rng(seed)
+    env._init_traffic()
+    return graph, env
+
+
+def bench_grid(size: int, episodes_list: List[int], repeats: int, seed: int) -> Dict[str, dict]:
+    graph, env = build_world(size, seed)
+    router = main.DijkstraRouter(graph, env)
+    start, goal = 0, graph.total_nodes - 1
+    results: Dict[str, dict] = {}
+
+    nodes = [random.randrange(graph.total_nodes) for _ in range(256)]
+    results["graph.get_neighbors"] = measure(lambda: [graph.get_neighbors(n) for n in nodes], repeats)
+    results["graph.get_neighbors"]["ops_per_call"] = len(nodes)
+
+    results["environment.update"] = measure(env.update, repeats)
+
+    results["router.edge_costs"] = measure(
+        lambda: (env.update(), router.edge_costs("ev", "standard")), repeats
+    )
+    if router.all_pairs_table("ev", "standard") is not None:
+        results["router.all_pairs_table"] = measure(
+            lambda: (env.update(), router.all_pairs_table("ev", "standard")), max(1, repeats // 10), warmup=0
+        )
+
+    # Queries run against a fixed environment, so per-version costs and tables are reused
+    pairs = [tuple(random.sample(range(graph.total_nodes), 2)) for _ in range(repeats + 1)]
+    for algorithm in main.ROUTING_ALGORITHMS:
+        queries = iter(pairs * 3)
+        results[f"router.find_route[{algorithm}]"] = measure(
+            lambda: router.find_route(*next(queries), "ev", "standard", algorithm), repeats
+        )
+
+    agent = main.QLearningAgent(graph, env)
+    for episodes in episodes_list:
+        for batch_size in (1, 256):
+            agent = main.QLearningAgent(graph, env)
+            results[f"agent.train[episodes={episodes},batch={batch_size}]"] = measure(
+                lambda: agent.train(start, goal, "ev", "standard", episodes, batch_size),
+                max(1, repeats // 10)
+            )
+    results["agent.find_route"] = measure(lambda: agent.find_route(start, goal, "ev"), repeats)
+    return results
+
+
+def bench_endpoint(episodes_list: List[int], repeats: int, seed: int) -> Dict[str, dict]:
+    try:
+        from fastapi.testclient import TestClient
+    except ImportError:  # httpx is only needed for the in-process client
+        return {}
+    # Swap in a seeded world; endpoints read these module globals on every call
+    main.city, main.env = build_world(main.city.grid_size or main.GRID_SIZE, seed)
+    main.route_cache = main.RouteCache()
+    main.rl_agent = main.QLearningAgent(main.city, main.env, cache=main.route_cache)
+    main.dijkstra_router = main.DijkstraRouter(main.city, main.env, cache=main.route_cache)
+    client = TestClient(main.app)
+    results = {}
+
+    def optimize_cold(payload: dict) -> dict:
+        # A fresh agent each call, so every run trains from a cold table instead of an early-stopped warm one
+        main.rl_agent = main.QLearningAgent(main.city, main.env, cache=main.route_cache)
+        response = client.post("/route/optimize", json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    for episodes in episodes_list:
+        start, goal = main.city.node_labels([0, main.city.total_nodes - 1])
+        payload = {"start_node": start, "goal_node": goal, "episodes": episodes}
+        spent: List[int] = []
+        name = f"POST /route/optimize[episodes={episodes}]"
+        results[name] = measure(lambda: spent.append(optimize_cold(payload)["episodes_spent"]), max(1, repeats // 10))
+        # Early stopping may end training before `episodes`
+        results[name]["mean_episodes_spent"] = round(sum(spent) / len(spent), 1)
+    return results
+
+
+def compare(current: dict, baseline: dict, threshold: float, min_ms: float) -> List[str]:
+    """Lists benchmarks whose p50 regressed by more than `threshold` relative to the baseline.
+
+    Timings below `min_ms` in both runs are skipped as timer noise.
+    """
+    regressions = []
+    for grid, benches in current["results"].items():
+        for name, stats in benches.items():
+            base = baseline.get("results", {}).get(grid, {}).get(name)
+            if not base or not base.get("p50_ms"):
+                continue
+            if max(base["p50_ms"], stats["p50_ms"]) < min_ms:
+                continue
+            ratio = stats["p50_ms"] / base["p50_ms"]
+            if ratio > 1 + threshold:
+                regressions.append(f"{grid} {name}: p50 {base['p50_ms']} -> {stats['p50_ms']} ms ({ratio:.2f}x)")
+    return regressions
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[8, 16, 32], help="Grid side lengths to sweep")
+    parser.add_argument("--episodes", type=int, nargs="+", default=[200, 1000], help="Training episode counts")
+    parser.add_argument("--repeats", type=int, default=50, help="Timed calls per micro-benchmark")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write JSON results to this file (default: stdout)")
+    parser.add_argument("--compare", help="Baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed p50 slowdown before flagging")
+    parser.add_argument("--min-ms", type=float, default=0.5, help="Ignore benchmarks faster than this when comparing")
+    parser.add_argument("--skip-endpoint", action="store_true", help="Skip the in-process /route/optimize run")
+    args = parser.parse_args(argv)
+
+    report = {
+        "meta": {
+            "timestamp": time.time(),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "sizes": args.sizes,
+            "episodes": args.episodes,
+        },
+        "results": {},
+    }
+    for size in args.sizes:
+        report["results"][f"grid_{size}"] = bench_grid(size, args.episodes, args.repeats, args.seed)
+    if not args.skip_endpoint:
+        report["results"]["endpoint"] = bench_endpoint(args.episodes, args.repeats, args.seed)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold, args.min_ms)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
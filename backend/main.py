@@ -1,17 +1,207 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, model_validator
+from typing import ClassVar, Dict, Iterator, List, Optional, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from multiprocessing import resource_tracker, shared_memory
+import bisect
+import copy
+import cProfile
+import functools
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import pstats
 import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
 import math
 import time
 
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no shared world
+    fcntl = None
+
+
+# ============================================================
+# Instrumentation
+# ============================================================
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_SAMPLE_RATE = float(os.environ.get("GREENPATH_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.environ.get("GREENPATH_PROFILE_SLOW_MS", "250"))
+MAX_STORED_PROFILES = 20
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class MetricsRegistry:
+    """In-process counters, gauges and histograms rendered in Prometheus text format."""
+
+    def __init__(self):
+        self.meta: Dict[str, Tuple[str, str]] = {}
+        self.series: Dict[str, Dict[tuple, object]] = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name: str, kind: str, text: str):
+        self.meta[name] = (kind, text)
+        self.series.setdefault(name, {})
+
+    def inc(self, name: str, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        """Sets a gauge, or a counter whose running total is kept elsewhere."""
+        with self.lock:
+            self.series[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """Adds one histogram sample; buckets are stored non-cumulatively with +Inf last."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            if key not in series:
+                series[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            entry = series[key]
+            entry[0][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            entry[1] += value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, (kind, text) in self.meta.items():
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in self.series[name].items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                        continue
+                    counts, total = value
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(key)} {total}")
+                    lines.append(f"{name}_count{format_labels(key)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.describe("greenpath_http_request_duration_seconds", "histogram", "Request latency by endpoint.")
+metrics.describe("greenpath_response_render_seconds", "histogram", "Time spent serializing JSON responses.")
+metrics.describe("greenpath_environment_update_seconds", "histogram", "Time per environment step.")
+metrics.describe("greenpath_router_seconds", "histogram", "Uncached route computations by algorithm.")
+metrics.describe("greenpath_router_nodes_settled_total", "counter", "Nodes settled by uncached route searches.")
+metrics.describe("greenpath_qlearning_route_seconds", "histogram", "Uncached greedy Q-learning route extraction.")
+metrics.describe("greenpath_training_chunk_seconds", "histogram", "Time per training chunk by mode.")
+metrics.describe("greenpath_training_episodes_total", "counter", "Training episodes run in this process.")
+metrics.describe("greenpath_training_steps_total", "counter", "Training steps (Bellman updates) run in this process.")
+metrics.describe("greenpath_planner_sweeps_total", "counter", "Value-iteration sweeps run by the planner.")
+metrics.describe("greenpath_q_table_states", "gauge", "States with at least one learned Q-value.")
+metrics.describe("greenpath_q_table_bytes", "gauge", "Memory held by Q-table values.")
+metrics.describe("greenpath_goal_tables", "gauge", "Per-goal Q-tables kept by the shared agent.")
+metrics.describe("greenpath_replay_transitions", "gauge", "Transitions held in the shared replay buffer.")
+metrics.describe("greenpath_route_cache_entries", "gauge", "Entries in the route cache.")
+metrics.describe("greenpath_route_cache_requests_total", "counter", "Route cache lookups by result.")
+metrics.describe("greenpath_simulation_runs", "gauge", "Simulation runs recorded.")
+
+profiles: deque = deque(maxlen=MAX_STORED_PROFILES)
+# cProfile allows one active profiler per process, so concurrent requests skip sampling
+profile_lock = threading.Lock()
+
+
+def profiled(endpoint):
+    """Samples GREENPATH_PROFILE_SAMPLE_RATE of calls under cProfile and keeps the slow ones."""
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+            return endpoint(*args, **kwargs)
+        if not profile_lock.acquire(blocking=False):
+            return endpoint(*args, **kwargs)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profiler.runcall(endpoint, *args, **kwargs)
+        finally:
+            profile_lock.release()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if elapsed_ms >= PROFILE_SLOW_MS:
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(25)
+                profiles.append({
+                    "endpoint": endpoint.__name__,
+                    "timestamp": time.time(),
+                    "elapsed_ms": round(elapsed_ms, 1),
+                    "stats": out.getvalue(),
+                })
+
+    return wrapper
+
+
+class InstrumentedJSONResponse(JSONResponse):
+    # Route payloads are built from plain Python scalars, so endpoints return this
+    # directly to skip FastAPI's per-item jsonable_encoder pass
+    def render(self, content) -> bytes:
+        with metrics.timer("greenpath_response_render_seconds"):
+            return super().render(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    if STATE_DIR:
+        save_state(STATE_DIR)
+    if shared_world is not None:
+        shared_world.close()
+
+
 app = FastAPI(
     title="GreenPath Logistics Engine",
     version="2.0.0",
-    description="Reinforcement Learning-powered logistics routing API"
+    description="Reinforcement Learning-powered logistics routing API",
+    lifespan=lifespan,
+    default_response_class=InstrumentedJSONResponse
 )
 
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.observe(
+        "greenpath_http_request_duration_seconds", time.perf_counter() - start,
+        method=request.method, endpoint=route.path if route else "unmatched", status=response.status_code
+    )
+    return response
+
 # --- CORS Middleware ---
 app.add_middleware(
     CORSMiddleware,
@@ -26,74 +216,477 @@ app.add_middleware(
 # City Graph
 # ============================================================
 
+GRID_SIZE = int(os.environ.get("GREENPATH_GRID_SIZE", "8"))
+# Optional road network to load instead of the random grid (CSV or .npy edge list)
+GRAPH_PATH = os.environ.get("GREENPATH_GRAPH_PATH")
+EDGE_LIST_CHUNK_ROWS = 200_000
+# Average nodes per spatial index cell; more means fewer, larger buckets
+SPATIAL_NODES_PER_CELL = 2.0
+EDGE_LIST_FIELDS = ("source", "target", "distance", "elevation", "source_x", "source_y", "target_x", "target_y")
+
+
 class CityGraph:
+    # Every array the graph is made of; the list mirrors are derived from them
+    ARRAYS = (
+        "coords", "sources", "targets", "distances", "elevations", "edge_ids",
+        "offsets", "edge_keys", "reverse_edges", "edge_table",
+    )
+
     def __init__(self, size: int = 8):
         self.grid_size = size
         self.total_nodes = size * size
-        self.edges: Dict[str, dict] = {}
+        self.num_roads = 0
+        # External id of every node for graphs imported with sparse ids; None when ids are 0..n-1
+        self.node_ids: Optional[np.ndarray] = None
         self._build_graph()
 
     def _build_graph(self):
         spacing = 100
+        edges = []
+        # Grid layout in metres: x grows with column, y with row
+        self.coords = np.zeros((self.total_nodes, 2), dtype=np.float64)
         for row in range(self.grid_size):
             for col in range(self.grid_size):
                 node = row * self.grid_size + col
+                self.coords[node] = (col * spacing, row * spacing)
                 # Right neighbor
                 if col < self.grid_size - 1:
                     right = row * self.grid_size + (col + 1)
                     dist = spacing + random.random() * 20
                     elev = (random.random() - 0.5) * 10
-                    self._add_edge(node, right, dist, elev)
+                    edges.append((node, right, dist, elev))
                 # Down neighbor
                 if row < self.grid_size - 1:
                     down = (row + 1) * self.grid_size + col
                     dist = spacing + random.random() * 20
                     elev = (random.random() - 0.5) * 10
-                    self._add_edge(node, down, dist, elev)
+                    edges.append((node, down, dist, elev))
                 # Diagonal (40% chance)
                 if col < self.grid_size - 1 and row < self.grid_size - 1 and random.random() > 0.6:
                     diag = (row + 1) * self.grid_size + (col + 1)
                     dist = spacing * 1.414 + random.random() * 20
                     elev = (random.random() - 0.5) * 15
-                    self._add_edge(node, diag, dist, elev)
+                    edges.append((node, diag, dist, elev))
+
+        roads = np.array(edges, dtype=np.float64).reshape(-1, 4)
+        self._set_roads(
+            roads[:, 0].astype(np.int64), roads[:, 1].astype(np.int64),
+            roads[:, 2], roads[:, 3]
+        )
+
+    def _set_roads(self, u: np.ndarray, v: np.ndarray, distance: np.ndarray, elevation: np.ndarray):
+        """Builds the CSR arrays from undirected roads; each road becomes two directed edges.
+
+        Outgoing edges of node u live in [offsets[u], offsets[u + 1]) sorted by target,
+        and edge_ids maps every directed edge back to its road.
+        """
+        self.num_roads = len(u)
+        road_ids = np.arange(self.num_roads, dtype=np.int64)
+        sources = np.concatenate([u, v])
+        targets = np.concatenate([v, u])
+        order = np.lexsort((targets, sources))
+
+        self.sources = sources[order].astype(np.int32)
+        self.targets = targets[order].astype(np.int32)
+        self.distances = np.concatenate([distance, distance])[order]
+        self.elevations = np.concatenate([elevation, -elevation])[order]
+        self.edge_ids = np.concatenate([road_ids, road_ids])[order]
+        counts = np.bincount(self.sources, minlength=self.total_nodes)
+        self.offsets = np.zeros(self.total_nodes + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        # Sorted (source, target) keys for vectorized edge lookup
+        self.edge_keys = self.sources.astype(np.int64) * self.total_nodes + self.targets
+        # reverse_edges[e] is the index of the opposite direction of edge e
+        self.reverse_edges = self.edge_indices(self.targets, self.sources)
+        # Padded (node, slot) -> edge index table for batched lookups; -1 marks no edge
+        self.max_degree = int(counts.max()) if self.num_roads else 0
+        self.edge_table = np.full((self.total_nodes, self.max_degree), -1, dtype=np.int64)
+        self.edge_table[self.sources, np.arange(len(self.sources)) - self.offsets[self.sources]] = np.arange(len(self.sources))
+        self._set_lists()
+
+    def _set_lists(self):
+        # Plain-list mirrors: scalar indexing into lists is much cheaper than into arrays
+        self.offsets_list = self.offsets.tolist()
+        self.targets_list = self.targets.tolist()
+        self.reverse_list = self.reverse_edges.tolist()
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.targets)
+
+    def save(self, directory: str):
+        """Writes the roads and coordinates as .npy files; the CSR arrays are rebuilt on load."""
+        os.makedirs(directory, exist_ok=True)
+        # One directed edge per road, in road-id order, reproduces the same road ids and CSR layout
+        _, first = np.unique(self.edge_ids, return_index=True)
+        save_array(os.path.join(directory, "road_nodes.npy"), np.stack([self.sources[first], self.targets[first]], axis=1).astype(np.int64))
+        save_array(os.path.join(directory, "road_attrs.npy"), np.stack([self.distances[first], self.elevations[first]], axis=1))
+        save_array(os.path.join(directory, "coords.npy"), self.coords)
+        ids_path = os.path.join(directory, "node_ids.npy")
+        if self.node_ids is not None:
+            save_array(ids_path, self.node_ids)
+        elif os.path.exists(ids_path):
+            os.remove(ids_path)
+        with open(os.path.join(directory, "graph.json"), "w") as f:
+            json.dump({"grid_size": self.grid_size, "total_nodes": self.total_nodes}, f)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["CityGraph"]:
+        meta_path = os.path.join(directory, "graph.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        graph = cls.__new__(cls)
+        graph.grid_size = meta["grid_size"]
+        graph.total_nodes = meta["total_nodes"]
+        graph.coords = np.load(os.path.join(directory, "coords.npy"))
+        ids_path = os.path.join(directory, "node_ids.npy")
+        graph.node_ids = np.load(ids_path) if os.path.exists(ids_path) else None
+        nodes = np.load(os.path.join(directory, "road_nodes.npy"), mmap_mode="r")
+        attrs = np.load(os.path.join(directory, "road_attrs.npy"), mmap_mode="r")
+        graph._set_roads(nodes[:, 0], nodes[:, 1], attrs[:, 0], attrs[:, 1])
+        return graph
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], grid_size: Optional[int] = None) -> "CityGraph":
+        """Wraps already-built ARRAYS (e.g. views into shared memory) without copying them."""
+        graph = cls.__new__(cls)
+        graph.grid_size = grid_size
+        for name in cls.ARRAYS:
+            setattr(graph, name, arrays[name])
+        graph.node_ids = arrays.get("node_ids")
+        graph.total_nodes = len(graph.coords)
+        graph.num_roads = len(graph.sources) // 2
+        graph.max_degree = graph.edge_table.shape[1]
+        graph._set_lists()
+        return graph
+
+    @classmethod
+    def from_edge_list(cls, path: str, chunk_rows: int = EDGE_LIST_CHUNK_ROWS) -> "CityGraph":
+        """Builds a graph from an edge list with one undirected road per row.
+
+        Rows are `source, target, distance, elevation`, optionally followed by
+        `source_x, source_y, target_x, target_y` in metres. CSV files are parsed
+        `chunk_rows` lines at a time (a non-numeric first line is a header); .npy
+        files hold an (n, 4) or (n, 8) array, or a structured array with those
+        field names, and are memory-mapped. Node ids are non-negative integers;
+        sparse ids are renumbered 0..n-1 in id order and kept in node_ids.
+        Nodes without coordinates sit at the origin. Of several roads between
+        the same two nodes only the shortest is kept.
+        """
+        chunks = cls._npy_chunks(path, chunk_rows) if path.endswith(".npy") else cls._csv_chunks(path, chunk_rows)
+        u_parts, v_parts, dist_parts, elev_parts = [], [], [], []
+        # (node id, x, y) rows; later rows win for a node listed more than once
+        coord_parts = []
+        for rows in chunks:
+            if rows.shape[1] not in (4, 8):
+                raise ValueError(f"{path}: expected 4 or 8 columns, got {rows.shape[1]}")
+            u, v = rows[:, 0], rows[:, 1]
+            if len(rows) and ((u < 0).any() or (v < 0).any() or (u % 1).any() or (v % 1).any()):
+                raise ValueError(f"{path}: node ids must be non-negative integers")
+            if not (np.isfinite(rows[:, 2]).all() and (rows[:, 2] > 0).all()):
+                raise ValueError(f"{path}: distances must be positive")
+            # Self-loops never lie on a shortest path and would duplicate CSR keys
+            rows = rows[u != v]
+            u, v = rows[:, 0].astype(np.int64), rows[:, 1].astype(np.int64)
+            u_parts.append(u)
+            v_parts.append(v)
+            dist_parts.append(rows[:, 2].copy())
+            elev_parts.append(rows[:, 3].copy())
+            if rows.shape[1] == 8 and len(rows):
+                coord_parts.append(np.column_stack([u, rows[:, 4:6]]))
+                coord_parts.append(np.column_stack([v, rows[:, 6:8]]))
 
-    def _add_edge(self, u: int, v: int, distance: float, elevation: float):
-        self.edges[f"{u}-{v}"] = {"distance": distance, "elevation": elevation}
-        self.edges[f"{v}-{u}"] = {"distance": distance, "elevation": -elevation}
+        u = np.concatenate(u_parts) if u_parts else np.zeros(0, dtype=np.int64)
+        v = np.concatenate(v_parts) if v_parts else np.zeros(0, dtype=np.int64)
+        distance = np.concatenate(dist_parts) if dist_parts else np.zeros(0)
+        elevation = np.concatenate(elev_parts) if elev_parts else np.zeros(0)
+        # Arrays are sized by node count, so ids become dense indices
+        node_ids = np.unique(np.concatenate([u, v]))
+        u, v = np.searchsorted(node_ids, u), np.searchsorted(node_ids, v)
+        graph = cls.__new__(cls)
+        graph.grid_size = None
+        graph.total_nodes = len(node_ids)
+        graph.node_ids = None if np.array_equal(node_ids, np.arange(len(node_ids))) else node_ids
+        graph.coords = np.zeros((graph.total_nodes, 2), dtype=np.float64)
+        if coord_parts:
+            listed = np.concatenate(coord_parts)
+            graph.coords[np.searchsorted(node_ids, listed[:, 0].astype(np.int64))] = listed[:, 1:]
+        # Parallel roads (in either direction) would duplicate CSR keys; only the shortest can be on a shortest path
+        keys = np.minimum(u, v) * graph.total_nodes + np.maximum(u, v)
+        order = np.lexsort((distance, keys))
+        _, first = np.unique(keys[order], return_index=True)
+        keep = np.sort(order[first])
+        graph._set_roads(u[keep], v[keep], distance[keep], elevation[keep])
+        return graph
+
+    @staticmethod
+    def _csv_chunks(path: str, chunk_rows: int) -> Iterator[np.ndarray]:
+        with open(path) as f:
+            first = f.readline()
+            if first.strip():
+                try:
+                    yield np.loadtxt([first], delimiter=",", ndmin=2, dtype=np.float64)
+                except ValueError:
+                    pass  # header row
+            while True:
+                lines = list(itertools.islice(f, chunk_rows))
+                if not lines:
+                    break
+                yield np.loadtxt(lines, delimiter=",", ndmin=2, dtype=np.float64)
+
+    @staticmethod
+    def _npy_chunks(path: str, chunk_rows: int) -> Iterator[np.ndarray]:
+        data = np.load(path, mmap_mode="r")
+        names = data.dtype.names
+        if names:
+            fields = [name for name in EDGE_LIST_FIELDS if name in names]
+        for first in range(0, len(data), chunk_rows):
+            chunk = data[first:first + chunk_rows]
+            if names:
+                yield np.stack([chunk[name].astype(np.float64) for name in fields], axis=1)
+            else:
+                yield np.asarray(chunk, dtype=np.float64).reshape(len(chunk), -1)
+
+    def node_index(self, node_id: int) -> int:
+        """The node with external id `node_id`, or -1 if there is none."""
+        if self.node_ids is None:
+            return node_id if 0 <= node_id < self.total_nodes else -1
+        i = int(np.searchsorted(self.node_ids, node_id))
+        return i if i < self.total_nodes and self.node_ids[i] == node_id else -1
+
+    def node_labels(self, nodes) -> List[int]:
+        """External ids of `nodes`, for responses."""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        return (nodes if self.node_ids is None else self.node_ids[nodes]).tolist()
 
     def get_neighbors(self, node: int) -> List[int]:
-        neighbors = []
-        for key in self.edges:
-            parts = key.split("-")
-            if int(parts[0]) == node:
-                neighbors.append(int(parts[1]))
-        return neighbors
+        return self.targets_list[self.offsets_list[node]:self.offsets_list[node + 1]]
+
+    def edge_range(self, node: int) -> Tuple[int, int]:
+        return self.offsets_list[node], self.offsets_list[node + 1]
+
+    def edge_index(self, u: int, v: int) -> int:
+        """Returns the CSR index of the directed edge u -> v, or -1 if absent."""
+        lo, hi = self.offsets_list[u], self.offsets_list[u + 1]
+        i = bisect.bisect_left(self.targets_list, v, lo, hi)
+        if i < hi and self.targets_list[i] == v:
+            return i
+        return -1
+
+    def edge_indices(self, u: np.ndarray, v: np.ndarray) -> np.ndarray:
+        """Vectorized edge_index over arrays of endpoints."""
+        keys = np.asarray(u, dtype=np.int64) * self.total_nodes + np.asarray(v, dtype=np.int64)
+        if self.num_edges == 0:
+            return np.full(keys.shape, -1, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.edge_keys, keys), self.num_edges - 1)
+        return np.where(self.edge_keys[idx] == keys, idx, -1)
 
     def get_edge(self, u: int, v: int) -> Optional[dict]:
-        return self.edges.get(f"{u}-{v}")
+        i = self.edge_index(u, v)
+        if i < 0:
+            return None
+        return {"distance": float(self.distances[i]), "elevation": float(self.elevations[i])}
+
+    @property
+    def spatial(self) -> "SpatialIndex":
+        """Grid index over node coordinates, built on first use."""
+        index = getattr(self, "_spatial", None)
+        if index is None:
+            index = self._spatial = SpatialIndex(self.coords)
+        return index
+
+
+class SpatialIndex:
+    """Uniform grid of buckets over node coordinates for nearest-node and radius queries.
+
+    Cells are sized to hold about SPATIAL_NODES_PER_CELL nodes on average and
+    are stored CSR-style: the nodes in cell c are
+    nodes[cell_offsets[c]:cell_offsets[c + 1]]. Every query takes an (n, 2)
+    array of points in metres and is answered for all of them at once.
+    """
+
+    def __init__(self, coords: np.ndarray, nodes_per_cell: float = SPATIAL_NODES_PER_CELL):
+        self.coords = coords
+        count = max(len(coords), 1)
+        self.origin = coords.min(axis=0) if len(coords) else np.zeros(2)
+        extent = coords.max(axis=0) - self.origin if len(coords) else np.zeros(2)
+        # Square cells covering the bounding box; the second bound keeps long, thin layouts from exploding the cell count
+        side = max(math.sqrt(extent[0] * extent[1] * nodes_per_cell / count), float(extent.max()) * nodes_per_cell / count)
+        self.cell_size = side if side > 0 else 1.0
+        self.shape = (extent // self.cell_size).astype(np.int64) + 1
+        cells = self._cell_ids(*self._cells(coords).T)
+        self.nodes = np.argsort(cells, kind="stable")
+        self.cell_offsets = np.zeros(int(self.shape.prod()) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=len(self.cell_offsets) - 1), out=self.cell_offsets[1:])
+
+    def _cells(self, points: np.ndarray) -> np.ndarray:
+        """(column, row) of the cell holding each point; points outside the grid go to the nearest edge cell."""
+        return np.clip(((points - self.origin) // self.cell_size).astype(np.int64), 0, self.shape - 1)
+
+    def _cell_ids(self, col: np.ndarray, row: np.ndarray) -> np.ndarray:
+        return row * self.shape[0] + col
+
+    def _gather(self, owners: np.ndarray, cells: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Expands (owner, cell) pairs into (owner, node) pairs for every node in those cells."""
+        starts = self.cell_offsets[cells]
+        counts = self.cell_offsets[cells + 1] - starts
+        first = np.cumsum(counts) - counts
+        positions = np.arange(int(counts.sum())) + np.repeat(starts - first, counts)
+        return np.repeat(owners, counts), self.nodes[positions]
+
+    @staticmethod
+    def _ring(radius: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Cell offsets at Chebyshev distance exactly `radius`."""
+        if radius == 0:
+            return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+        span = np.arange(-radius, radius + 1)
+        side = np.full(2 * radius - 1, radius)
+        dx = np.concatenate([span, span, -side, side])
+        dy = np.concatenate([np.full(len(span), -radius), np.full(len(span), radius), span[1:-1], span[1:-1]])
+        return dx, dy
+
+    def nearest(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Nearest node to each point and its straight-line distance; node -1 if the graph is empty.
+
+        Searches rings of cells outward from each point's cell. A point is done
+        once its best distance is within `ring * cell_size`, since every cell
+        further out is at least that far away.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        best = np.full(len(points), np.inf)
+        nearest = np.full(len(points), -1, dtype=np.int64)
+        if not len(self.coords):
+            return nearest, best
+        home = self._cells(points)
+        active = np.arange(len(points))
+        for radius in range(int(self.shape.max())):
+            dx, dy = self._ring(radius)
+            owners = np.repeat(active, len(dx))
+            col = home[owners, 0] + np.tile(dx, len(active))
+            row = home[owners, 1] + np.tile(dy, len(active))
+            inside = (col >= 0) & (col < self.shape[0]) & (row >= 0) & (row < self.shape[1])
+            owners, nodes = self._gather(owners[inside], self._cell_ids(col[inside], row[inside]))
+            if len(nodes):
+                offsets = self.coords[nodes] - points[owners]
+                dist = np.hypot(offsets[:, 0], offsets[:, 1])
+                np.minimum.at(best, owners, dist)
+                closest = dist == best[owners]
+                nearest[owners[closest]] = nodes[closest]
+            active = active[best[active] > radius * self.cell_size]
+            if not len(active):
+                break
+        return nearest, best
+
+    def within(self, points: np.ndarray, radius) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Nodes within `radius` metres (a scalar or one per point) of each point.
+
+        Returns CSR arrays (offsets, nodes, distances): point i's nodes are
+        nodes[offsets[i]:offsets[i + 1]], nearest first.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(points),))
+        lo = self._cells(points - radius[:, None])
+        hi = self._cells(points + radius[:, None])
+        width = hi[:, 0] - lo[:, 0] + 1
+        counts = width * (hi[:, 1] - lo[:, 1] + 1)
+        owners = np.repeat(np.arange(len(points)), counts)
+        k = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        col = lo[owners, 0] + k % width[owners]
+        row = lo[owners, 1] + k // width[owners]
+        owners, nodes = self._gather(owners, self._cell_ids(col, row))
+        offsets = self.coords[nodes] - points[owners]
+        dist = np.hypot(offsets[:, 0], offsets[:, 1])
+        keep = dist <= radius[owners]
+        owners, nodes, dist = owners[keep], nodes[keep], dist[keep]
+        order = np.lexsort((dist, owners))
+        result_offsets = np.zeros(len(points) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owners, minlength=len(points)), out=result_offsets[1:])
+        return result_offsets, nodes[order], dist[order]
 
 
 # ============================================================
 # Environment
 # ============================================================
 
+CHANGE_LOG_LENGTH = 64
+# Steps of traffic drawn ahead for forecast(), and route time units covered by one step
+FORECAST_HORIZON = int(os.environ.get("GREENPATH_FORECAST_HORIZON", "24"))
+FORECAST_STEP_TIME = float(os.environ.get("GREENPATH_FORECAST_STEP_TIME", "0.1"))
+
+
+def owned_traffic(traffic: np.ndarray) -> np.ndarray:
+    """`traffic` itself, or a copy if it is a read-only shared-world slot that a later push will overwrite."""
+    return traffic if traffic.flags.writeable else traffic.copy()
+
+
 class Environment:
-    def __init__(self, total_nodes: int):
-        self.total_nodes = total_nodes
-        self.traffic: Dict[str, float] = {}
+    def __init__(self, graph: CityGraph):
+        self.graph = graph
+        self.total_nodes = graph.total_nodes
+        self.rng = np.random.default_rng()
+        # One traffic factor per road, indexed by graph.edge_ids. The array is replaced,
+        # never written in place, so snapshots and scenario overlays can share it.
+        self.traffic = np.zeros(graph.num_roads, dtype=np.float64)
         self.rain: float = random.random() * 0.5
         self.flood_zones: set = set()
+        # Bumped on every change to traffic, rain or flood zones
+        self.version = 0
+        # Recent (version, changed roads, changed nodes) entries for incremental consumers
+        self.change_log: deque = deque(maxlen=CHANGE_LOG_LENGTH)
+        # Ring of pre-drawn traffic noise, allocated by the first forecast() call
+        self._noise: Optional[np.ndarray] = None
+        self._noise_head = 0
+        self._forecast: Optional[tuple] = None
         self._init_traffic()
 
     def _init_traffic(self):
-        for i in range(self.total_nodes):
-            for j in range(i + 1, self.total_nodes):
-                key = f"{min(i, j)}-{max(i, j)}"
-                self.traffic[key] = 0.5 * (0.6 + random.random() * 0.8)
+        self.traffic = 0.5 * (0.6 + self.rng.random(self.graph.num_roads) * 0.8)
+
+    def snapshot(self) -> "Environment":
+        """Returns an independent copy sharing the graph and the current traffic array."""
+        clone = copy.copy(self)
+        clone._reset_randomness()
+        clone.traffic = owned_traffic(self.traffic)
+        clone.flood_zones = set(self.flood_zones)
+        clone.change_log = deque(self.change_log, maxlen=CHANGE_LOG_LENGTH)
+        return clone
+
+    def save(self, directory: str):
+        """Writes traffic, rain and flood zones; the noise streams are redrawn on restore."""
+        os.makedirs(directory, exist_ok=True)
+        save_array(os.path.join(directory, "traffic.npy"), self.traffic)
+        with open(os.path.join(directory, "environment.json"), "w") as f:
+            json.dump({"rain": self.rain, "flood_zones": sorted(self.flood_zones)}, f)
+
+    def restore(self, directory: str) -> bool:
+        """Adopts conditions written by save(); False if there are none for this graph."""
+        meta_path = os.path.join(directory, "environment.json")
+        if not os.path.exists(meta_path):
+            return False
+        traffic = np.load(os.path.join(directory, "traffic.npy"))
+        if traffic.shape != (self.graph.num_roads,):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        self.traffic = traffic
+        self.rain = meta["rain"]
+        self.flood_zones = {node for node in meta["flood_zones"] if 0 <= node < self.total_nodes}
+        return True
+
+    def _reset_randomness(self):
+        """Gives a snapshot its own noise stream and an empty forecast ring."""
+        self.rng = np.random.default_rng()
+        self._noise = None
+        self._noise_head = 0
+        self._forecast = None
 
     def get_traffic_factor(self, u: int, v: int) -> float:
-        key = f"{min(u, v)}-{max(u, v)}"
-        return self.traffic.get(key, 0.5)
+        i = self.graph.edge_index(u, v)
+        if i < 0:
+            return 0.5
+        return float(self.traffic[self.graph.edge_ids[i]])
 
     def get_weather_impact(self, node: int) -> float:
         if node in self.flood_zones:
@@ -104,18 +697,389 @@ class Environment:
             return 1.5
         return 1.0
 
+    def traffic_factors(self, roads: np.ndarray) -> np.ndarray:
+        """Vectorized traffic lookup by road id."""
+        return self.traffic[roads]
+
+    def weather_impacts(self, nodes: Optional[np.ndarray] = None) -> np.ndarray:
+        """Vectorized get_weather_impact over all nodes, or only over `nodes`."""
+        if self.rain > 0.8:
+            base = 2.5
+        elif self.rain > 0.3:
+            base = 1.5
+        else:
+            base = 1.0
+        if nodes is None:
+            impacts = np.full(self.total_nodes, base, dtype=np.float64)
+            impacts[list(self.flood_zones)] = 5.0
+            return impacts
+        impacts = np.full(len(nodes), base, dtype=np.float64)
+        if self.flood_zones:
+            impacts[np.isin(nodes, list(self.flood_zones))] = 5.0
+        return impacts
+
+    def flood_mask(self) -> np.ndarray:
+        mask = np.zeros(self.total_nodes, dtype=bool)
+        mask[list(self.flood_zones)] = True
+        return mask
+
     def is_flooded(self, node: int) -> bool:
         return node in self.flood_zones
 
-    def update(self):
-        for key in self.traffic:
-            val = self.traffic[key]
-            self.traffic[key] = max(0.1, min(2.0, val + (random.random() - 0.5) * 0.3))
-        self.rain = max(0, min(1, self.rain + (random.random() - 0.5) * 0.1))
-        if random.random() > 0.95:
+    def forecast(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Traffic (H + 1, roads) and weather impact (H + 1, nodes) for the next FORECAST_HORIZON steps.
+
+        Row 0 is the current state. Traffic replays the random walk with noise
+        drawn ahead of time, which update() then consumes, so it is exact; rain
+        and flood zones have no drift and are held at their current values.
+        Cached until the version changes.
+        """
+        version = self.version
+        if self._forecast is not None and self._forecast[0] == version:
+            return self._forecast[1], self._forecast[2]
+        if self._noise is None:
+            self._noise = self._draw_noise((FORECAST_HORIZON, self.graph.num_roads))
+            self._noise_head = 0
+        traffic = np.empty((FORECAST_HORIZON + 1, self.graph.num_roads), dtype=np.float64)
+        traffic[0] = self.traffic
+        for k in range(FORECAST_HORIZON):
+            row = self._noise[(self._noise_head + k) % FORECAST_HORIZON]
+            np.clip(traffic[k] + row, 0.1, 2.0, out=traffic[k + 1])
+        weather = np.broadcast_to(self.weather_impacts(), (FORECAST_HORIZON + 1, self.total_nodes))
+        self._forecast = (version, traffic, weather)
+        return traffic, weather
+
+    def _draw_noise(self, shape: tuple) -> np.ndarray:
+        return (self.rng.random(shape) - 0.5) * 0.3
+
+    def _next_noise(self) -> np.ndarray:
+        """Traffic noise for the next step, from the forecast ring once one exists."""
+        if self._noise is None:
+            return self._draw_noise(self.traffic.shape)
+        noise = self._noise[self._noise_head].copy()
+        self._noise[self._noise_head] = self._draw_noise(self.traffic.shape)
+        self._noise_head = (self._noise_head + 1) % FORECAST_HORIZON
+        return noise
+
+    def record_change(self, roads: np.ndarray, nodes: np.ndarray):
+        """Bumps the version and logs which roads (traffic) and nodes (weather) changed."""
+        self.version += 1
+        self.change_log.append((self.version, roads, nodes))
+
+    def changes_since(self, version: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Roads and nodes changed after `version`, or None if the log no longer reaches back that far."""
+        entries = [entry for entry in self.change_log if entry[0] > version]
+        if len(entries) != self.version - version:
+            return None
+        if not entries:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        roads = np.unique(np.concatenate([entry[1] for entry in entries]))
+        nodes = np.unique(np.concatenate([entry[2] for entry in entries]))
+        return roads, nodes
+
+    def set_conditions(self, rain: Optional[float] = None, flood_zones: Optional[set] = None):
+        """Applies rain and/or flood-zone overrides, recording nodes whose weather impact changed."""
+        before = self.weather_impacts()
+        if rain is not None:
+            self.rain = rain
+        if flood_zones is not None:
             self.flood_zones.clear()
-            for _ in range(random.randint(0, 2)):
-                self.flood_zones.add(random.randint(0, self.total_nodes - 1))
+            self.flood_zones.update(flood_zones)
+        changed = np.nonzero(self.weather_impacts() != before)[0]
+        if len(changed):
+            self.record_change(np.zeros(0, dtype=np.int64), changed)
+
+    def update(self):
+        with metrics.timer("greenpath_environment_update_seconds"):
+            before = self.weather_impacts()
+            self.traffic = np.clip(self.traffic + self._next_noise(), 0.1, 2.0)
+            self.rain = max(0, min(1, self.rain + (random.random() - 0.5) * 0.1))
+            if random.random() > 0.95:
+                self.flood_zones.clear()
+                for _ in range(random.randint(0, 2)):
+                    self.flood_zones.add(random.randint(0, self.total_nodes - 1))
+            # The random walk moves every road's traffic each step
+            self.record_change(
+                np.arange(self.graph.num_roads, dtype=np.int64),
+                np.nonzero(self.weather_impacts() != before)[0]
+            )
+
+
+class ScenarioEnvironment(Environment):
+    """What-if overlay on a base Environment that stores only its deltas.
+
+    Traffic is the base's live array scaled by `traffic_scale`, with
+    `traffic_overrides` pinning individual roads; rain and flood zones follow
+    the base unless set. Nothing is copied until a vectorized consumer reads
+    `traffic`, so many scenarios can share one base.
+    """
+
+    def __init__(
+        self, base: Environment, rain: Optional[float] = None, flood_zones: Optional[set] = None,
+        traffic_scale: float = 1.0, traffic_overrides: Optional[Dict[int, float]] = None
+    ):
+        self.base = base
+        self.graph = base.graph
+        self.total_nodes = base.total_nodes
+        self.rng = np.random.default_rng()
+        self.change_log: deque = deque(maxlen=CHANGE_LOG_LENGTH)
+        self.local_version = 0
+        self._rain: Optional[float] = None
+        self._flood_zones: Optional[set] = None
+        self.traffic_scale = 1.0
+        self.traffic_overrides: Dict[int, float] = {}
+        self.set_conditions(rain, flood_zones, traffic_scale, traffic_overrides)
+
+    @property
+    def version(self) -> int:
+        # Both counters only grow, so the sum changes whenever either side does
+        return self.base.version + self.local_version
+
+    @property
+    def rain(self) -> float:
+        return self.base.rain if self._rain is None else self._rain
+
+    @property
+    def flood_zones(self) -> set:
+        return self.base.flood_zones if self._flood_zones is None else self._flood_zones
+
+    @property
+    def traffic(self) -> np.ndarray:
+        return self._apply_deltas(self.base.traffic)
+
+    def _apply_deltas(self, traffic: np.ndarray) -> np.ndarray:
+        """Scenario traffic from base traffic; works on one step or a stack of steps (roads last)."""
+        if self.traffic_scale == 1.0 and not self.traffic_overrides:
+            return traffic
+        merged = np.clip(traffic * self.traffic_scale, 0.1, 2.0)
+        if self.traffic_overrides:
+            roads = np.fromiter(self.traffic_overrides.keys(), dtype=np.int64, count=len(self.traffic_overrides))
+            merged[..., roads] = np.fromiter(self.traffic_overrides.values(), dtype=np.float64, count=len(roads))
+        return merged
+
+    def forecast(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The base forecast with this scenario's deltas; overridden roads stay pinned."""
+        traffic, _ = self.base.forecast()
+        weather = np.broadcast_to(self.weather_impacts(), (len(traffic), self.total_nodes))
+        return self._apply_deltas(traffic), weather
+
+    def get_traffic_factor(self, u: int, v: int) -> float:
+        i = self.graph.edge_index(u, v)
+        if i < 0:
+            return 0.5
+        road = int(self.graph.edge_ids[i])
+        if road in self.traffic_overrides:
+            return self.traffic_overrides[road]
+        return min(2.0, max(0.1, float(self.base.traffic[road]) * self.traffic_scale))
+
+    def traffic_factors(self, roads: np.ndarray) -> np.ndarray:
+        factors = np.clip(self.base.traffic[roads] * self.traffic_scale, 0.1, 2.0)
+        if self.traffic_overrides:
+            pinned = np.fromiter(self.traffic_overrides.keys(), dtype=np.int64, count=len(self.traffic_overrides))
+            values = np.fromiter(self.traffic_overrides.values(), dtype=np.float64, count=len(pinned))
+            order = np.argsort(pinned)
+            pinned, values = pinned[order], values[order]
+            pos = np.minimum(np.searchsorted(pinned, roads), len(pinned) - 1)
+            factors = np.where(pinned[pos] == roads, values[pos], factors)
+        return factors
+
+    def set_conditions(
+        self, rain: Optional[float] = None, flood_zones: Optional[set] = None,
+        traffic_scale: Optional[float] = None, traffic_overrides: Optional[Dict[int, float]] = None
+    ):
+        """Replaces the given deltas; arguments left as None keep their current value."""
+        if rain is not None:
+            self._rain = rain
+        if flood_zones is not None:
+            self._flood_zones = set(flood_zones)
+        if traffic_scale is not None:
+            self.traffic_scale = traffic_scale
+        if traffic_overrides is not None:
+            self.traffic_overrides = dict(traffic_overrides)
+        self.local_version += 1
+
+    def changes_since(self, version: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        return None if version != self.version else (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    def snapshot(self) -> Environment:
+        """Materializes the scenario's current state as a plain, independent Environment."""
+        clone = Environment.__new__(Environment)
+        clone.graph = self.graph
+        clone.total_nodes = self.total_nodes
+        clone._reset_randomness()
+        clone.traffic = owned_traffic(self.traffic)
+        clone.rain = self.rain
+        clone.flood_zones = set(self.flood_zones)
+        clone.version = self.version
+        clone.change_log = deque(maxlen=CHANGE_LOG_LENGTH)
+        return clone
+
+
+# ============================================================
+# Route Cache
+# ============================================================
+
+ROUTE_CACHE_MAX_ENTRIES = 1024
+ROUTE_CACHE_TTL_SECONDS = 60.0
+
+
+class RouteCache:
+    """LRU cache of route results with a TTL, stamped with the state version they were computed at.
+
+    An entry only hits while the caller's current version matches its stamp,
+    so bumping Environment.version (or the agent's version) invalidates it.
+    """
+
+    def __init__(self, max_entries: int = ROUTE_CACHE_MAX_ENTRIES, ttl_seconds: float = ROUTE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, version) -> Optional[dict]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                stamp, expires_at, result = entry
+                if stamp == version and expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, version, result: dict):
+        with self._lock:
+            self.entries[key] = (version, time.monotonic() + self.ttl_seconds, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups * 100, 1) if lookups > 0 else 0,
+        }
+
+
+# ============================================================
+# Path Evaluation
+# ============================================================
+
+class PathEvaluator:
+    """Per-segment fuel, time, CO2 and condition labels for one or many paths.
+
+    All segments of all paths are evaluated together as array operations over
+    CSR edge indices. Steps come back as plain dicts of Python scalars, so a
+    response can be rendered without building a model per step.
+    """
+
+    def __init__(self, graph: CityGraph, env: Environment):
+        self.graph = graph
+        self.env = env
+
+    def evaluate(self, path: List[int], vehicle_type: str, reasons: bool = False, forecast: bool = False) -> dict:
+        return self.evaluate_many([path], vehicle_type, reasons, forecast)[0]
+
+    def evaluate_many(
+        self, paths: List[List[int]], vehicle_type: str, reasons: bool = False, forecast: bool = False
+    ) -> List[dict]:
+        """With `reasons`, steps carry a traffic/weather explanation; with `forecast`,
+        each segment uses the forecast step it starts in. Pairs that are not
+        edges of the graph are skipped.
+        """
+        graph = self.graph
+        sizes = np.fromiter((len(p) for p in paths), dtype=np.int64, count=len(paths))
+        nodes = np.fromiter(itertools.chain.from_iterable(paths), dtype=np.int64, count=int(sizes.sum()))
+        # Consecutive pairs of the concatenation, minus those joining one path to the next
+        joins = np.cumsum(sizes)[:-1] - 1
+        keep = np.ones(max(len(nodes) - 1, 0), dtype=bool)
+        keep[joins[(joins >= 0) & (joins < len(keep))]] = False
+        owner = np.repeat(np.arange(len(paths)), np.maximum(sizes - 1, 0))
+        u, v = nodes[:-1][keep], nodes[1:][keep]
+        edges = graph.edge_indices(u, v)
+        found = edges >= 0
+        if not found.all():
+            owner, v, edges = owner[found], v[found], edges[found]
+        counts = np.bincount(owner, minlength=len(paths))
+
+        distance = graph.distances[edges]
+        roads = graph.edge_ids[edges]
+        if forecast:
+            tf, wi = self._forecast_factors(roads, v, distance, counts)
+        else:
+            tf = self.env.traffic_factors(roads)
+            wi = self.env.weather_impacts(v)
+        mult = get_consumption_multiplier(vehicle_type)
+        fuel = (distance * 0.00025 + np.maximum(0, graph.elevations[edges] * 0.0001)) * mult * tf * wi
+        seg_time = distance * 0.002 * tf * wi
+
+        total_fuel = np.bincount(owner, weights=fuel, minlength=len(paths)).tolist()
+        total_time = np.bincount(owner, weights=seg_time, minlength=len(paths)).tolist()
+        total_distance = np.bincount(owner, weights=distance, minlength=len(paths)).tolist()
+
+        step_nodes = v.tolist()
+        traffic_level = np.round(tf, 3).tolist()
+        condition = np.where(wi > 1.2, "rainy", "clear").tolist()
+        fuel_cost = np.round(fuel, 5).tolist()
+        time_cost = np.round(seg_time, 3).tolist()
+        if reasons:
+            reason = np.where(
+                tf > 1.2, "Heavy traffic but shortest fuel path.",
+                np.where(wi > 1.2, "Weather impact significant, but safe.", "Optimal path found.")
+            ).tolist()
+        else:
+            reason = [None] * len(step_nodes)
+
+        co2_factor = get_co2_factor(vehicle_type)
+        results = []
+        hi = 0
+        for i, path in enumerate(paths):
+            lo, hi = hi, hi + int(counts[i])
+            steps = [
+                {"node": n, "traffic_level": t, "weather_condition": w, "fuel_cost": f, "time_cost": c, "reason": r}
+                for n, t, w, f, c, r in zip(
+                    step_nodes[lo:hi], traffic_level[lo:hi], condition[lo:hi],
+                    fuel_cost[lo:hi], time_cost[lo:hi], reason[lo:hi]
+                )
+            ]
+            results.append({
+                "path": path,
+                "steps": steps,
+                "total_fuel": round(total_fuel[i], 5),
+                "total_time": round(total_time[i], 3),
+                "total_distance": round(total_distance[i], 2),
+                "co2_emissions": round(total_fuel[i] * co2_factor, 5),
+            })
+        return results
+
+    def _forecast_factors(
+        self, roads: np.ndarray, targets: np.ndarray, distance: np.ndarray, counts: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Forecast traffic and weather for each segment at the step its path reaches it.
+
+        A segment's step depends on the time spent on the segments before it,
+        so every segment starts at step 0 and the steps are re-derived until
+        they settle; each pass fixes at least one more segment per path.
+        """
+        traffic, weather = self.env.forecast()
+        firsts = np.cumsum(counts) - counts
+        steps = np.zeros(len(roads), dtype=np.int64)
+        while True:
+            tf = traffic[steps, roads]
+            wi = weather[steps, targets]
+            elapsed = np.concatenate([[0.0], np.cumsum(distance * 0.002 * tf * wi)])
+            before = elapsed[:-1] - np.repeat(elapsed[firsts], counts)
+            new_steps = np.minimum(FORECAST_HORIZON, (before / FORECAST_STEP_TIME).astype(np.int64))
+            if np.array_equal(new_steps, steps):
+                return tf, wi
+            steps = new_steps
 
 
 # ============================================================
@@ -137,29 +1101,488 @@ def get_co2_factor(vehicle_type: str) -> float:
     return 2.31
 
 
+# Traffic is clipped to [0.1, 2.0] so int(traffic * 5) spans 0..10
+TRAFFIC_BUCKETS = 11
+# Distinct values returned by Environment.get_weather_impact
+WEATHER_LEVELS = [1.0, 1.5, 2.5, 5.0]
+_WEATHER_INDEX = {w: i for i, w in enumerate(WEATHER_LEVELS)}
+
+
+def traffic_bucket(traffic: float) -> int:
+    return min(int(traffic * 5), TRAFFIC_BUCKETS - 1)
+
+def traffic_buckets(traffic: np.ndarray) -> np.ndarray:
+    return np.minimum((traffic * 5).astype(np.int64), TRAFFIC_BUCKETS - 1)
+
+def weather_bucket(weather: float) -> int:
+    i = _WEATHER_INDEX.get(weather)
+    if i is None:
+        i = min(bisect.bisect_left(WEATHER_LEVELS, weather), len(WEATHER_LEVELS) - 1)
+    return i
+
+def weather_buckets(weather: np.ndarray) -> np.ndarray:
+    return np.minimum(np.searchsorted(WEATHER_LEVELS, weather), len(WEATHER_LEVELS) - 1)
+
+
+class DictQTable:
+    """Sparse Q-table keyed by "{node}-{traffic}-{weather}" strings, then by next node."""
+
+    writeable = True
+
+    def __init__(self, graph: CityGraph):
+        self.graph = graph
+        self.table: Dict[str, Dict[int, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def copy(self) -> "DictQTable":
+        clone = DictQTable(self.graph)
+        clone.table = {state: dict(actions) for state, actions in self.table.items()}
+        return clone
+
+    def state(self, node: int, traffic: float, weather: float) -> str:
+        return f"{node}-{int(traffic * 5)}-{int(weather * 5)}"
+
+    def get(self, state: str, action: int) -> float:
+        return self.table.get(state, {}).get(action, 0.0)
+
+    def set(self, state: str, action: int, value: float):
+        if state not in self.table:
+            self.table[state] = {}
+        self.table[state][action] = value
+
+    def best_action(self, state: str, candidates: List[int]) -> int:
+        best_val = -math.inf
+        best = candidates[0]
+        for n in candidates:
+            q = self.get(state, n)
+            if q > best_val:
+                best_val = q
+                best = n
+        return best
+
+    def max_value(self, state: str, node: int) -> float:
+        return max([self.get(state, n) for n in self.graph.get_neighbors(node)] or [0])
+
+    def write_plan(self, edge_values: np.ndarray, edge_traffic: np.ndarray, node_weather: np.ndarray):
+        """Stores per-edge Q-values under every state key the current conditions can produce."""
+        graph = self.graph
+        values, traffic, weather = edge_values.tolist(), edge_traffic.tolist(), node_weather.tolist()
+        for node in range(graph.total_nodes):
+            lo, hi = graph.edge_range(node)
+            if lo == hi:
+                continue
+            actions = dict(zip(graph.targets_list[lo:hi], values[lo:hi]))
+            # A state is keyed by the traffic towards whichever neighbor is first unvisited
+            for tf in set(traffic[lo:hi]):
+                self.table[self.state(node, tf, weather[node])] = dict(actions)
+
+
+class DenseQTable:
+    """Array-backed Q-table indexed by (traffic bucket, weather bucket, CSR edge).
+
+    The state node is implied by the edge's source, so every state owns the
+    contiguous slice of its outgoing edges and memory is fixed at
+    TRAFFIC_BUCKETS * len(WEATHER_LEVELS) * num_edges floats.
+    """
+
+    def __init__(self, graph: CityGraph):
+        self.graph = graph
+        self.values = np.zeros((TRAFFIC_BUCKETS, len(WEATHER_LEVELS), graph.num_edges), dtype=np.float64)
+        self.visited = np.zeros((graph.total_nodes, TRAFFIC_BUCKETS, len(WEATHER_LEVELS)), dtype=bool)
+
+    def __len__(self) -> int:
+        return int(self.visited.sum())
+
+    @property
+    def writeable(self) -> bool:
+        """False for read-only views, e.g. tables published to a shared world."""
+        return self.values.flags.writeable
+
+    def copy(self) -> "DenseQTable":
+        clone = DenseQTable.__new__(DenseQTable)
+        clone.graph = self.graph
+        clone.values = self.values.copy()
+        clone.visited = self.visited.copy()
+        return clone
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        save_array(os.path.join(directory, "q_values.npy"), self.values)
+        save_array(os.path.join(directory, "q_visited.npy"), self.visited)
+
+    @classmethod
+    def load(cls, graph: CityGraph, directory: str) -> Optional["DenseQTable"]:
+        """Memory-maps a saved table copy-on-write: workers share its pages until they train."""
+        values_path = os.path.join(directory, "q_values.npy")
+        if not os.path.exists(values_path):
+            return None
+        values = np.load(values_path, mmap_mode="c")
+        if values.shape != (TRAFFIC_BUCKETS, len(WEATHER_LEVELS), graph.num_edges):
+            return None
+        table = cls.__new__(cls)
+        table.graph = graph
+        table.values = values
+        table.visited = np.load(os.path.join(directory, "q_visited.npy"), mmap_mode="c")
+        return table
+
+    def state(self, node: int, traffic: float, weather: float) -> Tuple[int, int, int]:
+        return node, traffic_bucket(traffic), weather_bucket(weather)
+
+    def best_action(self, state: Tuple[int, int, int], candidates: List[int]) -> int:
+        node, t, w = state
+        lo, hi = self.graph.edge_range(node)
+        allowed = set(candidates)
+        best_val = -math.inf
+        best = candidates[0]
+        for n, q in zip(self.graph.get_neighbors(node), self.values[t, w, lo:hi].tolist()):
+            if q > best_val and n in allowed:
+                best_val = q
+                best = n
+        return best
+
+    def max_value(self, state: Tuple[int, int, int], node: int) -> float:
+        _, t, w = state
+        lo, hi = self.graph.edge_range(node)
+        return float(self.values[t, w, lo:hi].max()) if hi > lo else 0.0
+
+    def write_plan(self, edge_values: np.ndarray, edge_traffic: np.ndarray, node_weather: np.ndarray):
+        """Stores per-edge Q-values under every state the current conditions can produce.
+
+        A state's traffic bucket comes from whichever outgoing edge leads to the
+        first unvisited neighbor, so each node's values are written once per
+        distinct bucket among its edges; other conditions keep what they learned.
+        """
+        table = self.graph.edge_table
+        has_edge = table >= 0
+        safe_table = np.where(has_edge, table, 0)
+        edge_t = traffic_buckets(edge_traffic)
+        node_w = weather_buckets(node_weather)
+        # One candidate state per (node, outgoing edge), each covering all of the node's edges
+        nodes, slots = np.nonzero(has_edge)
+        state_t = edge_t[safe_table[nodes, slots]]
+        rows = has_edge[nodes]
+        edges = safe_table[nodes][rows]
+        t = np.broadcast_to(state_t[:, None], rows.shape)[rows]
+        w = np.broadcast_to(node_w[nodes][:, None], rows.shape)[rows]
+        self.values[t, w, edges] = edge_values[edges]
+        self.visited[nodes, state_t, node_w[nodes]] = True
+
+
+Q_TABLE_BACKENDS = {"dict": DictQTable, "dense": DenseQTable}
+# Dense tables grow with the edge count, so large imported networks fall back to the sparse dict
+DENSE_Q_TABLE_MAX_MB = float(os.environ.get("GREENPATH_DENSE_Q_MAX_MB", "256"))
+
+
+def default_q_backend(graph: CityGraph) -> str:
+    states = TRAFFIC_BUCKETS * len(WEATHER_LEVELS)
+    nbytes = states * (graph.num_edges * 8 + graph.total_nodes)
+    return "dense" if nbytes <= DENSE_Q_TABLE_MAX_MB * 1024 * 1024 else "dict"
+
+
+# Per-goal Q-tables kept by an agent; dense tables are further capped to DENSE_Q_TABLE_MAX_MB in total
+GOAL_TABLES_MAX = int(os.environ.get("GREENPATH_GOAL_TABLES", "32"))
+REPLAY_CAPACITY = int(os.environ.get("GREENPATH_REPLAY_CAPACITY", "200000"))
+# Transitions replayed before training and after every chunk
+REPLAY_BATCH = 4096
+# With early stopping, sequential training is checked for convergence at least this
+# often; lockstep batches are checked after each batch of batch_size episodes
+EARLY_STOP_CHUNK = 50
+
+
+def goal_table_limit(graph: CityGraph, q_backend: str) -> int:
+    """How many per-goal tables an agent keeps; dense ones also share the dense memory budget."""
+    if q_backend == "dense":
+        per_table = max(TRAFFIC_BUCKETS * len(WEATHER_LEVELS) * graph.num_edges * 8, 1)
+        return max(1, min(GOAL_TABLES_MAX, int(DENSE_Q_TABLE_MAX_MB * 1024 * 1024 // per_table)))
+    return max(1, GOAL_TABLES_MAX)
+
+
+class ReplayBuffer:
+    """Fixed-capacity ring of observed dense-table transitions.
+
+    Each entry is (traffic bucket, weather bucket, edge, next traffic bucket,
+    next weather bucket). Rewards and goals are left out: they are recomputed
+    from the current reward model when replayed, so experience gathered for one
+    goal or profile trains any other.
+    """
+
+    FIELDS = ("t", "w", "edge", "next_t", "next_w")
+
+    def __init__(self, capacity: int = REPLAY_CAPACITY):
+        self.capacity = capacity
+        self.t = np.zeros(capacity, dtype=np.int8)
+        self.w = np.zeros(capacity, dtype=np.int8)
+        self.edge = np.zeros(capacity, dtype=np.int64)
+        self.next_t = np.zeros(capacity, dtype=np.int8)
+        self.next_w = np.zeros(capacity, dtype=np.int8)
+        self.size = 0
+        # Total transitions ever added; the write position is added % capacity
+        self.added = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, t: np.ndarray, w: np.ndarray, edge: np.ndarray, next_t: np.ndarray, next_w: np.ndarray):
+        columns = (t, w, edge, next_t, next_w)
+        n = len(edge)
+        if n > self.capacity:
+            columns = tuple(np.asarray(c)[-self.capacity:] for c in columns)
+            n = self.capacity
+        with self.lock:
+            slots = (self.added + np.arange(n)) % self.capacity
+            for name, column in zip(self.FIELDS, columns):
+                getattr(self, name)[slots] = column
+            self.added += n
+            self.size = min(self.capacity, self.size + n)
+
+    def contents(self, newest: Optional[int] = None) -> Tuple[np.ndarray, ...]:
+        """Stored columns oldest-first, or just the `newest` entries."""
+        with self.lock:
+            n = self.size if newest is None else min(newest, self.size)
+            slots = (self.added - n + np.arange(n)) % self.capacity
+            return tuple(getattr(self, name)[slots] for name in self.FIELDS)
+
+    def sample(self, n: int, rng: np.random.Generator) -> Tuple[np.ndarray, ...]:
+        with self.lock:
+            slots = rng.integers(0, self.size, n)
+            return tuple(getattr(self, name)[slots] for name in self.FIELDS)
+
+
 class QLearningAgent:
-    def __init__(self, graph: CityGraph, env: Environment):
+    def __init__(
+        self, graph: CityGraph, env: Environment, q_backend: str = "dense",
+        cache: Optional[RouteCache] = None
+    ):
+        if q_backend not in Q_TABLE_BACKENDS:
+            raise ValueError(f"Unknown Q-table backend: {q_backend}")
         self.graph = graph
         self.env = env
-        self.q_table: Dict[str, Dict[int, float]] = {}
+        self.q_backend = q_backend
+        # The table being trained; goal_tables holds one per recently trained goal, least recent first
+        self.q_table = Q_TABLE_BACKENDS[q_backend](graph)
+        self.goal_tables: "OrderedDict[int, object]" = OrderedDict()
+        self.replay = ReplayBuffer() if q_backend == "dense" else None
+        self.cache = cache
+        self.evaluator = PathEvaluator(graph, env)
+        # Bumped whenever the Q-table changes, so cached routes go stale
+        self.version = 0
         self.lr = 0.1
         self.gamma = 0.9
         self.epsilon = 0.1
 
-    def _state_key(self, node: int, traffic: float, weather: float) -> str:
-        return f"{node}-{int(traffic * 5)}-{int(weather * 5)}"
+    def publish(self, q_table, goal: Optional[int] = None):
+        """Atomically replaces the Q-table (for `goal`, if given) with one trained elsewhere."""
+        self.q_table = q_table
+        if goal is not None:
+            self._remember(goal, q_table)
+        self.version += 1
+
+    def max_goal_tables(self) -> int:
+        return goal_table_limit(self.graph, self.q_backend)
+
+    def _remember(self, goal: int, q_table):
+        self.goal_tables[goal] = q_table
+        self.goal_tables.move_to_end(goal)
+        while len(self.goal_tables) > self.max_goal_tables():
+            self.goal_tables.popitem(last=False)
+
+    def nearest_goal(self, goal: int) -> Optional[int]:
+        if not self.goal_tables:
+            return None
+        goals = np.fromiter(self.goal_tables.keys(), dtype=np.int64, count=len(self.goal_tables))
+        offsets = self.graph.coords[goals] - self.graph.coords[goal]
+        return int(goals[np.einsum("ij,ij->i", offsets, offsets).argmin()])
+
+    def table_for(self, goal: int):
+        """The table trained for `goal`, else the one for the nearest trained goal, else the current one."""
+        table = self.goal_tables.get(goal)
+        if table is not None:
+            return table
+        nearest = self.nearest_goal(goal)
+        return self.q_table if nearest is None else self.goal_tables[nearest]
+
+    def select_goal(self, goal: int) -> str:
+        """Makes `goal`'s table the one being trained; returns "hit", "nearby" or "cold".
+
+        A goal without a table starts from a copy of the nearest trained goal's
+        table, or of a goal-less table (e.g. one loaded from disk). A read-only
+        table is copied before it is trained.
+        """
+        table = self.goal_tables.get(goal)
+        if table is not None:
+            status = "hit"
+            if not table.writeable:
+                table = table.copy()
+        elif self.goal_tables or len(self.q_table):
+            table, status = self.table_for(goal).copy(), "nearby"
+        else:
+            table, status = Q_TABLE_BACKENDS[self.q_backend](self.graph), "cold"
+        self.q_table = table
+        self._remember(goal, table)
+        return status
+
+    def snapshot_for(self, goal: int) -> tuple:
+        """(goal it was trained for or None, private copy) of the table training for `goal` would start from."""
+        source = goal if goal in self.goal_tables else self.nearest_goal(goal)
+        return source, self.table_for(goal).copy()
+
+    def _state_key(self, node: int, traffic: float, weather: float):
+        return self.q_table.state(node, traffic, weather)
 
-    def _get_q(self, state_key: str, action: int) -> float:
-        return self.q_table.get(state_key, {}).get(action, 0.0)
+    def _get_q(self, state_key, action: int) -> float:
+        return self.q_table.get(state_key, action)
 
-    def _set_q(self, state_key: str, action: int, value: float):
-        if state_key not in self.q_table:
-            self.q_table[state_key] = {}
-        self.q_table[state_key][action] = value
+    def _set_q(self, state_key, action: int, value: float):
+        self.q_table.set(state_key, action, value)
 
-    def train(self, start: int, goal: int, vehicle_type: str, priority: str, episodes: int = 200) -> List[float]:
+    def edge_rewards(self, vehicle_type: str, priority: str) -> np.ndarray:
+        """Immediate reward for taking every directed edge under the current environment."""
+        mult = get_consumption_multiplier(vehicle_type)
+        tf = self.env.traffic[self.graph.edge_ids]
+        wi = self.env.weather_impacts()[self.graph.targets]
+        fuel = self.graph.distances * 0.00025 * mult * tf * wi
+        time_cost = self.graph.distances * 0.002 * tf * wi
+        if priority in ("critical", "high"):
+            rewards = -(time_cost * 80 + fuel * 5)
+        elif priority == "low":
+            rewards = -(fuel * 50 + time_cost * 2)
+        else:
+            rewards = -(fuel * 25 + time_cost * 15)
+        rewards[self.env.flood_mask()[self.graph.targets]] = -10000
+        return rewards
+
+    def plan(self, start: int, goal: int, vehicle_type: str, priority: str) -> dict:
+        """Solves for `goal` under the current environment instead of sampling episodes.
+
+        The reward model is known, so Q(e) = r(e) + V(target(e)) is found by
+        value iteration over edge arrays, with V(goal) = 0 and every other node
+        starting at -inf. Values only rise, so each sweep re-evaluates just the
+        neighbors of nodes that improved in the previous one. The sweeps stop
+        one after the longest optimal path's hop count. Returns are
+        undiscounted: at gamma = 0.9, costs beyond a few dozen hops vanish and
+        greedy routes on large grids wander instead of reaching the goal.
+        The result is written into the Q-table that find_route reads.
+        """
+        self.select_goal(goal)
+        graph = self.graph
+        rewards = self.edge_rewards(vehicle_type, priority)
+        table = graph.edge_table
+        has_edge = table >= 0
+        safe_table = np.where(has_edge, table, 0)
+
+        values = np.full(graph.total_nodes, -np.inf)
+        values[goal] = 0.0
+        changed = np.array([goal], dtype=np.int64)
+        sweeps = 0
+        with metrics.timer("greenpath_training_chunk_seconds", mode="planner"):
+            while len(changed):
+                sweeps += 1
+                # Roads are two-way, so the nodes whose values can move are the neighbors of changed ones
+                nodes = np.unique(graph.targets[table[changed][has_edge[changed]]])
+                nodes = nodes[nodes != goal]
+                edges = safe_table[nodes]
+                q = np.where(has_edge[nodes], rewards[edges] + values[graph.targets[edges]], -np.inf)
+                best = q.max(axis=1)
+                improved = best > values[nodes]
+                changed = nodes[improved]
+                values[changed] = best[improved]
+
+            # Dead ends and nodes cut off from the goal rank below every node that can reach it
+            reachable = np.isfinite(values)
+            values[~reachable] = values[reachable].min() - 10000.0
+            q = rewards + values[graph.targets]
+            self.q_table.write_plan(q, self.env.traffic[graph.edge_ids], self.env.weather_impacts())
+        self.version += 1
+        metrics.inc("greenpath_planner_sweeps_total", sweeps)
+        return {"sweeps": sweeps, "start_value": float(values[start])}
+
+    def train(
+        self, start: int, goal: int, vehicle_type: str, priority: str,
+        episodes: int = 200, batch_size: int = 1, early_stop: bool = False
+    ) -> List[float]:
+        """Runs up to `episodes` training episodes and returns each episode's total reward."""
+        rewards_history = []
+        for rewards in self.iter_train(start, goal, vehicle_type, priority, episodes, batch_size, early_stop=early_stop):
+            rewards_history.extend(rewards)
+        return rewards_history
+
+    def iter_train(
+        self, start: int, goal: int, vehicle_type: str, priority: str,
+        episodes: int = 200, batch_size: int = 1, report_every: int = 10, early_stop: bool = False,
+        status: Optional[str] = None
+    ) -> Iterator[List[float]]:
+        """Generator form of train: yields the rewards of each completed chunk of episodes.
+
+        Trains `goal`'s own table, selecting it first unless the caller already
+        did and passes select_goal's result as `status`. With batch_size > 1 and
+        the dense backend, episodes advance in lockstep batches via _train_batch
+        and each batch is one chunk; otherwise they run one at a time and are
+        reported every `report_every` episodes. Dense tables also replay stored
+        transitions before the first chunk and after each one. With
+        `early_stop`, sequential chunks are at most EARLY_STOP_CHUNK episodes and
+        training ends once two checks in a row give the same greedy route and
+        that route reaches the goal; for a warm table the route before training
+        is the first check. Closing the generator stops training at the next
+        chunk boundary.
+        """
+        if status is None:
+            status = self.select_goal(goal)
+        batched = batch_size > 1 and isinstance(self.q_table, DenseQTable)
+        chunk = batch_size if batched else report_every
+        if early_stop and not batched:
+            chunk = min(chunk, EARLY_STOP_CHUNK)
+        self._replay(goal, vehicle_type, priority)
+        # Bumped after every change to the table, so a route cached mid-update is never current
+        self.version += 1
+        previous = self._greedy_path(self.q_table, start, goal) if early_stop and status != "cold" else None
+        if previous is not None and previous[-1] != goal:
+            previous = None
+        for first in range(0, episodes, chunk):
+            n = min(chunk, episodes - first)
+            with metrics.timer("greenpath_training_chunk_seconds", mode="batch" if batched else "sequential"):
+                if batched:
+                    rewards = self._train_batch(start, goal, vehicle_type, priority, n)
+                else:
+                    rewards = self._train_sequential(start, goal, vehicle_type, priority, n)
+                self._replay(goal, vehicle_type, priority)
+            self.version += 1
+            metrics.inc("greenpath_training_episodes_total", n)
+            yield rewards
+            if early_stop:
+                path = self._greedy_path(self.q_table, start, goal)
+                if path[-1] == goal and path == previous:
+                    return
+                previous = path
+
+    def _replay(self, goal: int, vehicle_type: str, priority: str):
+        """Bellman updates for `goal` on REPLAY_BATCH stored transitions, rewarded by the current model."""
+        if self.replay is None or not len(self.replay) or not isinstance(self.q_table, DenseQTable):
+            return
+        graph = self.graph
+        q = self.q_table.values
+        t, w, edges, next_t, next_w = self.replay.sample(REPLAY_BATCH, self.env.rng)
+        t, w, next_t, next_w = (a.astype(np.int64) for a in (t, w, next_t, next_w))
+        rewards = self.edge_rewards(vehicle_type, priority)[edges]
+        next_nodes = graph.targets[edges]
+        table = graph.edge_table
+        next_has = table[next_nodes] >= 0
+        next_q = np.where(next_has, q[next_t[:, None], next_w[:, None], np.where(next_has, table[next_nodes], 0)], -np.inf)
+        max_next_q = np.where(next_has.any(axis=1) & (next_nodes != goal), next_q.max(axis=1), 0.0)
+        delta = self.lr * (rewards + self.gamma * max_next_q - q[t, w, edges])
+        flat = np.ravel_multi_index((t, w, edges), q.shape)
+        cells, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+        q.reshape(-1)[cells] += np.bincount(inverse, weights=delta) / counts
+        self.q_table.visited[graph.sources[edges], t, w] = True
+
+    def _train_sequential(self, start: int, goal: int, vehicle_type: str, priority: str, episodes: int) -> List[float]:
+        if isinstance(self.q_table, DenseQTable):
+            return self._train_sequential_dense(start, goal, vehicle_type, priority, episodes)
         rewards_history = []
         mult = get_consumption_multiplier(vehicle_type)
+        total_steps = 0
 
         for _ in range(episodes):
             current = start
@@ -180,13 +1603,7 @@ class QLearningAgent:
                 if random.random() < self.epsilon:
                     next_node = random.choice(neighbors)
                 else:
-                    best_val = -math.inf
-                    next_node = neighbors[0]
-                    for n in neighbors:
-                        q = self._get_q(state_key, n)
-                        if q > best_val:
-                            best_val = q
-                            next_node = n
+                    next_node = self.q_table.best_action(state_key, neighbors)
 
                 edge = self.graph.get_edge(current, next_node)
                 if not edge:
@@ -214,8 +1631,7 @@ class QLearningAgent:
                 next_traffic = tf
                 next_weather = wi
                 next_state_key = self._state_key(next_node, next_traffic, next_weather)
-                next_neighbors = self.graph.get_neighbors(next_node)
-                max_next_q = max([self._get_q(next_state_key, n) for n in next_neighbors] or [0])
+                max_next_q = 0.0 if next_node == goal else self.q_table.max_value(next_state_key, next_node)
                 current_q = self._get_q(state_key, next_node)
                 new_q = current_q + self.lr * (reward + self.gamma * max_next_q - current_q)
                 self._set_q(state_key, next_node, new_q)
@@ -225,87 +1641,210 @@ class QLearningAgent:
                 steps += 1
 
             rewards_history.append(total_reward)
+            total_steps += steps
 
+        metrics.inc("greenpath_training_steps_total", total_steps)
         return rewards_history
 
-    def find_route(self, start: int, goal: int, vehicle_type: str) -> dict:
-        path = [start]
-        steps = []
-        current = start
-        visited = {start}
-        total_fuel = 0.0
-        total_time = 0.0
-        total_distance = 0.0
-        mult = get_consumption_multiplier(vehicle_type)
+    def _train_sequential_dense(self, start: int, goal: int, vehicle_type: str, priority: str, episodes: int) -> List[float]:
+        """_train_sequential for dense tables, working on CSR edge positions throughout.
 
-        for _ in range(100):
-            if current == goal:
-                break
+        Outgoing edges of a node are a contiguous CSR range, so the chosen
+        neighbor's edge index is known without a lookup. Rewards and state
+        buckets come from per-edge and per-node lists computed once per call.
+        """
+        rewards_history = []
+        offsets, targets = self.graph.offsets_list, self.graph.targets_list
+        values, visited_states = self.q_table.values, self.q_table.visited
+        rewards = self.edge_rewards(vehicle_type, priority).tolist()
+        edge_t = traffic_buckets(self.env.traffic[self.graph.edge_ids]).tolist()
+        node_w = weather_buckets(self.env.weather_impacts()).tolist()
+        lr, gamma, epsilon = self.lr, self.gamma, self.epsilon
+        total_steps = 0
+        transitions: List[tuple] = []
 
-            neighbors = [n for n in self.graph.get_neighbors(current) if n not in visited]
-            if not neighbors:
-                # Allow backtracking
-                all_nb = [n for n in self.graph.get_neighbors(current) if n != current]
-                if not all_nb:
-                    break
-                neighbors = all_nb
+        for _ in range(episodes):
+            current = start
+            visited = {start}
+            total_reward = 0.0
+            steps = 0
 
-            traffic = self.env.get_traffic_factor(current, neighbors[0])
-            weather = self.env.get_weather_impact(current)
-            state_key = self._state_key(current, traffic, weather)
-
-            best_val = -math.inf
-            best_node = neighbors[0]
-            for n in neighbors:
-                q = self._get_q(state_key, n)
-                if q > best_val:
-                    best_val = q
-                    best_node = n
-
-            edge = self.graph.get_edge(current, best_node)
-            if not edge:
-                break
+            while current != goal and steps < 50:
+                lo, hi = offsets[current], offsets[current + 1]
+                edges = [e for e in range(lo, hi) if targets[e] not in visited]
+                if not edges:
+                    break
+                # The state's traffic is that of the edge to the first unvisited neighbor
+                t, w = edge_t[edges[0]], node_w[current]
 
-            tf = self.env.get_traffic_factor(current, best_node)
-            wi = self.env.get_weather_impact(best_node)
-
-            seg_fuel = (edge["distance"] * 0.00025 + max(0, edge["elevation"] * 0.0001)) * mult * tf * wi
-            seg_time = edge["distance"] * 0.002 * tf * wi
-
-            total_fuel += seg_fuel
-            total_time += seg_time
-            total_distance += edge["distance"]
-
-            reason = "Optimal path found."
-            if tf > 1.2:
-                reason = "Heavy traffic but shortest fuel path."
-            elif wi > 1.2:
-                reason = "Weather impact significant, but safe."
-
-            steps.append({
-                "node": best_node,
-                "traffic_level": round(tf, 3),
-                "weather_condition": "rainy" if wi > 1.2 else "clear",
-                "fuel_cost": round(seg_fuel, 5),
-                "time_cost": round(seg_time, 3),
-                "reason": reason
-            })
+                # Epsilon-greedy action selection
+                if random.random() < epsilon:
+                    edge = random.choice(edges)
+                else:
+                    q = values[t, w, lo:hi].tolist()
+                    edge, best = edges[0], -math.inf
+                    for e in edges:
+                        if q[e - lo] > best:
+                            edge, best = e, q[e - lo]
 
-            path.append(best_node)
-            visited.add(best_node)
-            current = best_node
+                next_node = targets[edge]
+                reward = rewards[edge]
+                total_reward += reward
 
-        co2 = total_fuel * get_co2_factor(vehicle_type)
+                # Bellman update
+                next_t, next_w = edge_t[edge], node_w[next_node]
+                next_lo, next_hi = offsets[next_node], offsets[next_node + 1]
+                if next_node == goal or next_hi == next_lo:
+                    max_next_q = 0.0
+                else:
+                    max_next_q = max(values[next_t, next_w, next_lo:next_hi].tolist())
+                current_q = values.item((t, w, edge))
+                values[t, w, edge] = current_q + lr * (reward + gamma * max_next_q - current_q)
+                visited_states[current, t, w] = True
+                if self.replay is not None:
+                    transitions.append((t, w, edge, next_t, next_w))
 
-        return {
-            "path": path,
-            "steps": steps,
-            "total_fuel": round(total_fuel, 5),
-            "total_time": round(total_time, 3),
-            "total_distance": round(total_distance, 2),
-            "co2_emissions": round(co2, 5),
-            "algorithm": "QLearning"
-        }
+                visited.add(next_node)
+                current = next_node
+                steps += 1
+
+            rewards_history.append(total_reward)
+            total_steps += steps
+
+        if transitions:
+            self.replay.add(*(np.array(column) for column in zip(*transitions)))
+        metrics.inc("greenpath_training_steps_total", total_steps)
+        return rewards_history
+
+    def _train_batch(self, start: int, goal: int, vehicle_type: str, priority: str, n: int) -> List[float]:
+        """Advances n independent episodes in lockstep as arrays of walkers.
+
+        Mirrors the sequential loop: each walker picks an unvisited neighbor
+        epsilon-greedily, and Bellman updates from all walkers are applied per
+        step. Walkers hitting the same (state, action) in one step contribute
+        their mean update so large batches do not overshoot the learning rate.
+        """
+        graph = self.graph
+        q = self.q_table.values
+        rng = self.env.rng
+
+        edge_table = graph.edge_table
+        has_edge = edge_table >= 0
+        safe_table = np.where(has_edge, edge_table, 0)
+        slot_targets = graph.targets[safe_table]
+        rewards = self.edge_rewards(vehicle_type, priority)
+        edge_t = traffic_buckets(self.env.traffic[graph.edge_ids])
+        node_w = weather_buckets(self.env.weather_impacts())
+
+        current = np.full(n, start, dtype=np.int64)
+        visited = np.zeros((n, graph.total_nodes), dtype=bool)
+        visited[:, start] = True
+        active = np.full(n, start != goal)
+        totals = np.zeros(n, dtype=np.float64)
+        total_steps = 0
+
+        for _ in range(50):
+            walkers = np.nonzero(active)[0]
+            if len(walkers) == 0:
+                break
+            nodes = current[walkers]
+            candidates = has_edge[nodes] & ~visited[walkers[:, None], slot_targets[nodes]]
+            stuck = ~candidates.any(axis=1)
+            active[walkers[stuck]] = False
+            walkers, nodes, candidates = walkers[~stuck], nodes[~stuck], candidates[~stuck]
+            if len(walkers) == 0:
+                break
+            edges = safe_table[nodes]
+            rows = np.arange(len(walkers))
+            total_steps += len(walkers)
+
+            # State uses the traffic towards the first unvisited neighbor
+            t = edge_t[edges[rows, candidates.argmax(axis=1)]]
+            w = node_w[nodes]
+
+            # Epsilon-greedy action selection
+            q_vals = np.where(candidates, q[t[:, None], w[:, None], edges], -np.inf)
+            greedy = q_vals.argmax(axis=1)
+            random_pick = np.where(candidates, rng.random(candidates.shape), -1.0).argmax(axis=1)
+            slot = np.where(rng.random(len(walkers)) < self.epsilon, random_pick, greedy)
+            chosen = edges[rows, slot]
+            next_nodes = graph.targets[chosen].astype(np.int64)
+
+            reward = rewards[chosen]
+            totals[walkers] += reward
+
+            # Bellman update
+            next_t = edge_t[chosen]
+            next_w = node_w[next_nodes]
+            next_has = has_edge[next_nodes]
+            next_q = np.where(next_has, q[next_t[:, None], next_w[:, None], safe_table[next_nodes]], -np.inf)
+            max_next_q = np.where(next_has.any(axis=1) & (next_nodes != goal), next_q.max(axis=1), 0.0)
+            current_q = q[t, w, chosen]
+            delta = self.lr * (reward + self.gamma * max_next_q - current_q)
+
+            flat = np.ravel_multi_index((t, w, chosen), q.shape)
+            cells, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+            q.reshape(-1)[cells] += np.bincount(inverse, weights=delta) / counts
+            self.q_table.visited[nodes, t, w] = True
+            if self.replay is not None:
+                self.replay.add(t, w, chosen, next_t, next_w)
+
+            visited[walkers, next_nodes] = True
+            current[walkers] = next_nodes
+            active[walkers[next_nodes == goal]] = False
+
+        metrics.inc("greenpath_training_steps_total", total_steps)
+        return totals.tolist()
+
+    def find_route(self, start: int, goal: int, vehicle_type: str) -> dict:
+        if self.cache is None:
+            return self._find_route(start, goal, vehicle_type)
+        key = (start, goal, vehicle_type, None, "QLearning")
+        version = (self.env.version, self.version)
+        result = self.cache.get(key, version)
+        if result is None:
+            result = self._find_route(start, goal, vehicle_type)
+            self.cache.put(key, version, result)
+        return result
+
+    def _find_route(self, start: int, goal: int, vehicle_type: str) -> dict:
+        with metrics.timer("greenpath_qlearning_route_seconds"):
+            return self._greedy_route(start, goal, vehicle_type)
+
+    def _greedy_route(self, start: int, goal: int, vehicle_type: str) -> dict:
+        path = self._greedy_path(self.table_for(goal), start, goal)
+        result = self.evaluator.evaluate(path, vehicle_type, reasons=True)
+        result["algorithm"] = "QLearning"
+        return result
+
+    def _greedy_path(self, q_table, start: int, goal: int) -> List[int]:
+        path = [start]
+        current = start
+        visited = {start}
+
+        for _ in range(100):
+            if current == goal:
+                break
+
+            neighbors = [n for n in self.graph.get_neighbors(current) if n not in visited]
+            if not neighbors:
+                # Allow backtracking
+                all_nb = [n for n in self.graph.get_neighbors(current) if n != current]
+                if not all_nb:
+                    break
+                neighbors = all_nb
+
+            traffic = self.env.get_traffic_factor(current, neighbors[0])
+            weather = self.env.get_weather_impact(current)
+            state_key = q_table.state(current, traffic, weather)
+
+            best_node = q_table.best_action(state_key, neighbors)
+
+            path.append(best_node)
+            visited.add(best_node)
+            current = best_node
+
+        return path
 
 
 # ============================================================
@@ -314,132 +1853,1605 @@ class QLearningAgent:
 
 import heapq
 
+ROUTING_ALGORITHMS = {
+    "dijkstra": "Dijkstra",
+    "astar": "AStar",
+    "bidirectional": "BidirectionalDijkstra",
+    "incremental": "LPAStar",
+    "table": "AllPairsTable",
+    "time_dependent": "TimeDependentDijkstra",
+}
+# Incremental planners kept alive per (start, goal, vehicle, priority)
+MAX_ACTIVE_PLANNERS = 256
+# Above this share of changed edges a fresh search beats repairing
+INCREMENTAL_REPAIR_MAX_FRACTION = 0.25
+# Total memory allowed for precomputed all-pairs tables; larger graphs fall back to search
+APSP_MEMORY_BUDGET_MB = float(os.environ.get("GREENPATH_APSP_BUDGET_MB", "4"))
+
+
+class SearchLabels:
+    """Distance/predecessor labels over all nodes, reset lazily by bumping a generation stamp."""
+
+    def __init__(self, total_nodes: int):
+        self.dist = [math.inf] * total_nodes
+        self.prev = [-1] * total_nodes
+        self.stamp = [0] * total_nodes
+        self.generation = 0
+
+    def reset(self):
+        self.generation += 1
+
+    def reached(self, node: int) -> bool:
+        return self.stamp[node] == self.generation
+
+    def set(self, node: int, dist: float, prev: int):
+        self.dist[node] = dist
+        self.prev[node] = prev
+        self.stamp[node] = self.generation
+
+    def path_to(self, node: int) -> List[int]:
+        path = [node]
+        while self.prev[node] != -1:
+            node = self.prev[node]
+            path.append(node)
+        path.reverse()
+        return path
+
+
+class LPAStarPlanner:
+    """Lifelong Planning A* for one (start, goal) pair.
+
+    g/rhs values survive between queries; after edge costs change only the
+    heads of changed edges are re-queued, so a repair re-expands just the part
+    of the search the change actually affects. The heuristic must stay
+    admissible under every future cost, so it uses static lower bounds.
+    """
+
+    def __init__(self, graph: CityGraph, reverse: List[int], start: int, goal: int, costs: List[float], per_metre: float):
+        self.graph = graph
+        self.reverse = reverse
+        self.start = start
+        self.goal = goal
+        self.per_metre = per_metre
+        self.version = -1
+        self.reset(costs)
+
+    def reset(self, costs: List[float]):
+        self.costs = costs
+        self.g: Dict[int, float] = {}
+        self.rhs: Dict[int, float] = {self.start: 0.0}
+        self.queue: List[tuple] = []
+        self.queued: Dict[int, tuple] = {}
+        self._push(self.start)
+
+    def _h(self, node: int) -> float:
+        xs, goal = self.graph.coords, self.goal
+        return self.per_metre * math.hypot(xs[node, 0] - xs[goal, 0], xs[node, 1] - xs[goal, 1])
+
+    def _key(self, node: int) -> tuple:
+        m = min(self.g.get(node, math.inf), self.rhs.get(node, math.inf))
+        return (m + self._h(node), m)
+
+    def _push(self, node: int):
+        key = self._key(node)
+        self.queued[node] = key
+        heapq.heappush(self.queue, (key, node))
+
+    def _update_vertex(self, node: int):
+        if node != self.start:
+            offsets, targets = self.graph.offsets_list, self.graph.targets_list
+            best = math.inf
+            for e in range(offsets[node], offsets[node + 1]):
+                pred = targets[e]
+                cand = self.g.get(pred, math.inf) + self.costs[self.reverse[e]]
+                if cand < best:
+                    best = cand
+            self.rhs[node] = best
+        self.queued.pop(node, None)
+        if self.g.get(node, math.inf) != self.rhs.get(node, math.inf):
+            self._push(node)
+
+    def update_edges(self, costs: List[float], edges: np.ndarray):
+        """Switches to the new cost array and re-queues the heads of changed edges."""
+        self.costs = costs
+        targets = self.graph.targets
+        for node in np.unique(targets[edges]).tolist():
+            self._update_vertex(node)
+
+    def compute(self) -> Tuple[Optional[List[int]], int]:
+        offsets, targets = self.graph.offsets_list, self.graph.targets_list
+        expanded = 0
+        while self.queue:
+            key, u = self.queue[0]
+            if self.queued.get(u) != key:
+                heapq.heappop(self.queue)
+                continue
+            if key >= self._key(self.goal) and self.rhs.get(self.goal, math.inf) == self.g.get(self.goal, math.inf):
+                break
+            heapq.heappop(self.queue)
+            del self.queued[u]
+            expanded += 1
+            if self.g.get(u, math.inf) > self.rhs.get(u, math.inf):
+                self.g[u] = self.rhs[u]
+            else:
+                self.g[u] = math.inf
+                self._update_vertex(u)
+            for e in range(offsets[u], offsets[u + 1]):
+                self._update_vertex(targets[e])
+        return self._extract_path(), expanded
+
+    def _extract_path(self) -> Optional[List[int]]:
+        if self.g.get(self.goal, math.inf) == math.inf:
+            return None
+        offsets, targets = self.graph.offsets_list, self.graph.targets_list
+        path = [self.goal]
+        node = self.goal
+        while node != self.start and len(path) <= self.graph.total_nodes:
+            best, best_pred = math.inf, -1
+            for e in range(offsets[node], offsets[node + 1]):
+                pred = targets[e]
+                cand = self.g.get(pred, math.inf) + self.costs[self.reverse[e]]
+                if cand < best:
+                    best, best_pred = cand, pred
+            if best_pred < 0:
+                return None
+            path.append(best_pred)
+            node = best_pred
+        path.reverse()
+        return path
+
+
+class AllPairsTable:
+    """All-pairs cost, route length and next-hop matrices for one cost profile, built by vectorized Floyd-Warshall.
+
+    length[i, j] is the road length in metres of the least-cost route, not the shortest distance.
+    """
+
+    def __init__(self, graph: CityGraph, costs: np.ndarray, version: int):
+        n = graph.total_nodes
+        self.version = version
+        self.dist = np.full((n, n), np.inf, dtype=np.float64)
+        self.length = np.full((n, n), np.inf, dtype=np.float64)
+        self.next_hop = np.full((n, n), -1, dtype=np.int32)
+        # Assign in descending cost order so the cheapest of any parallel edges wins
+        order = np.argsort(-costs, kind="stable")
+        self.dist[graph.sources[order], graph.targets[order]] = costs[order]
+        self.length[graph.sources[order], graph.targets[order]] = graph.distances[order]
+        self.next_hop[graph.sources[order], graph.targets[order]] = graph.targets[order]
+        np.fill_diagonal(self.dist, 0.0)
+        np.fill_diagonal(self.length, 0.0)
+        np.fill_diagonal(self.next_hop, np.arange(n, dtype=np.int32))
+
+        alt = np.empty_like(self.dist)
+        alt_length = np.empty_like(self.length)
+        better = np.empty(self.dist.shape, dtype=bool)
+        for k in range(n):
+            np.add(self.dist[:, k, None], self.dist[k], out=alt)
+            np.less(alt, self.dist, out=better)
+            np.copyto(self.dist, alt, where=better)
+            np.add(self.length[:, k, None], self.length[k], out=alt_length)
+            np.copyto(self.length, alt_length, where=better)
+            np.copyto(self.next_hop, self.next_hop[:, k, None], where=better)
+
+    @staticmethod
+    def nbytes_for(total_nodes: int) -> int:
+        return total_nodes * total_nodes * (8 + 8 + 4)
+
+    def path(self, start: int, goal: int) -> Optional[List[int]]:
+        if self.next_hop[start, goal] < 0:
+            return None
+        path = [start]
+        node = start
+        while node != goal:
+            node = int(self.next_hop[node, goal])
+            path.append(node)
+        return path
+
+
 class DijkstraRouter:
-    def __init__(self, graph: CityGraph, env: Environment):
+    def __init__(self, graph: CityGraph, env: Environment, cache: Optional[RouteCache] = None):
         self.graph = graph
         self.env = env
+        self.cache = cache
+        self._xs = graph.coords[:, 0].tolist()
+        self._ys = graph.coords[:, 1].tolist()
+        self._reverse = graph.reverse_list
+        self._cost_cache: Dict[tuple, tuple] = {}
+        self._forecast_cache: Dict[tuple, tuple] = {}
+        self._planners: "OrderedDict[tuple, LPAStarPlanner]" = OrderedDict()
+        self._planner_lock = threading.Lock()
+        self._tables: Dict[tuple, AllPairsTable] = {}
+        self._table_lock = threading.Lock()
+        self.table_budget_bytes = int(APSP_MEMORY_BUDGET_MB * 1024 * 1024)
+        # Search labels are reused across queries but must not be shared between request threads
+        self._local = threading.local()
+        self.evaluator = PathEvaluator(graph, env)
+
+    def find_route(
+        self, start: int, goal: int, vehicle_type: str, priority: str, algorithm: str = "dijkstra"
+    ) -> dict:
+        if algorithm not in ROUTING_ALGORITHMS:
+            raise ValueError(f"Unknown routing algorithm: {algorithm}")
+        if self.cache is None:
+            return self._find_route(start, goal, vehicle_type, priority, algorithm)
+        key = (start, goal, vehicle_type, priority, ROUTING_ALGORITHMS[algorithm])
+        result = self.cache.get(key, self.env.version)
+        if result is None:
+            result = self._find_route(start, goal, vehicle_type, priority, algorithm)
+            self.cache.put(key, self.env.version, result)
+        return result
+
+    def edge_costs(self, vehicle_type: str, priority: str) -> Tuple[List[float], float]:
+        """Routing cost of every directed edge, plus the minimum cost per metre of straight-line
+        distance (the A* heuristic scale). Cached until the environment version changes."""
+        key = (vehicle_type, priority)
+        cached = self._cost_cache.get(key)
+        if cached is not None and cached[0] == self.env.version:
+            return cached[1], cached[2]
 
-    def find_route(self, start: int, goal: int, vehicle_type: str, priority: str) -> dict:
-        dist = {i: math.inf for i in range(self.graph.total_nodes)}
-        prev = {i: None for i in range(self.graph.total_nodes)}
-        dist[start] = 0
-        pq = [(0, start)]
+        graph = self.graph
+        costs, _ = self._cost_arrays(self.env.traffic, self.env.weather_impacts(), vehicle_type, priority)
+
+        # Any path costs at least per_metre times the straight-line distance it covers
+        lengths = np.hypot(*(graph.coords[graph.targets] - graph.coords[graph.sources]).T)
+        positive = lengths > 0
+        per_metre = float((costs[positive] / lengths[positive]).min()) if positive.any() else 0.0
+
+        cost_list = costs.tolist()
+        self._cost_cache[key] = (self.env.version, cost_list, per_metre)
+        return cost_list, per_metre
+
+    def _cost_arrays(
+        self, traffic: np.ndarray, weather: np.ndarray, vehicle_type: str, priority: str
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Per-edge routing cost and travel time given per-road traffic and per-node weather."""
+        graph = self.graph
         mult = get_consumption_multiplier(vehicle_type)
+        tf = traffic[graph.edge_ids]
+        wi = weather[graph.targets]
+        flood_penalty = np.where(self.env.flood_mask()[graph.targets], 500.0, 0.0)
+        time_cost = graph.distances * 0.002 * tf * wi
+        fuel_cost = graph.distances * 0.00025 * mult * tf * wi
+        if priority in ("critical", "high"):
+            costs = time_cost + flood_penalty
+        elif priority == "low":
+            costs = fuel_cost * 2 + flood_penalty
+        else:
+            costs = fuel_cost * 5 + time_cost * 2 + flood_penalty
+        return costs, time_cost
+
+    def forecast_edge_costs(self, vehicle_type: str, priority: str, step: int) -> Tuple[List[float], List[float]]:
+        """Edge costs and travel times at forecast `step`, built on first use and cached per version."""
+        key = (vehicle_type, priority, step)
+        cached = self._forecast_cache.get(key)
+        if cached is not None and cached[0] == self.env.version:
+            return cached[1], cached[2]
+        traffic, weather = self.env.forecast()
+        costs, times = self._cost_arrays(traffic[step], weather[step], vehicle_type, priority)
+        cost_list, time_list = costs.tolist(), times.tolist()
+        self._forecast_cache[key] = (self.env.version, cost_list, time_list)
+        return cost_list, time_list
 
+    def static_per_metre(self, vehicle_type: str, priority: str) -> float:
+        """Per-metre cost lower bound valid for any environment (traffic >= 0.1, weather >= 1)."""
+        mult = get_consumption_multiplier(vehicle_type)
+        if priority in ("critical", "high"):
+            coef = 0.002
+        elif priority == "low":
+            coef = 0.00025 * mult * 2
+        else:
+            coef = 0.00025 * mult * 5 + 0.002 * 2
+        graph = self.graph
+        lengths = np.hypot(*(graph.coords[graph.targets] - graph.coords[graph.sources]).T)
+        positive = lengths > 0
+        if not positive.any():
+            return 0.0
+        return float((coef * 0.1 * graph.distances[positive] / lengths[positive]).min())
+
+    def _incremental(self, start: int, goal: int, vehicle_type: str, priority: str, costs: List[float]):
+        """Routes with a persistent LPA* planner, repairing it from the environment's change log."""
+        key = (start, goal, vehicle_type, priority)
+        with self._planner_lock:
+            planner = self._planners.get(key)
+            if planner is None:
+                planner = LPAStarPlanner(
+                    self.graph, self._reverse, start, goal, costs,
+                    self.static_per_metre(vehicle_type, priority)
+                )
+                self._planners[key] = planner
+                while len(self._planners) > MAX_ACTIVE_PLANNERS:
+                    self._planners.popitem(last=False)
+            elif planner.version != self.env.version:
+                changes = self.env.changes_since(planner.version)
+                edges = None
+                if changes is not None:
+                    roads, nodes = changes
+                    changed = np.isin(self.graph.edge_ids, roads) | np.isin(self.graph.targets, nodes)
+                    edges = np.nonzero(changed)[0]
+                if edges is None or len(edges) > INCREMENTAL_REPAIR_MAX_FRACTION * self.graph.num_edges:
+                    planner.reset(costs)
+                else:
+                    planner.update_edges(costs, edges)
+            self._planners.move_to_end(key)
+            planner.version = self.env.version
+            return planner.compute()
+
+    def all_pairs_table(self, vehicle_type: str, priority: str) -> Optional[AllPairsTable]:
+        """Returns an up-to-date all-pairs table for the profile, or None if it would exceed the memory budget."""
+        key = (vehicle_type, priority)
+        with self._table_lock:
+            table = self._tables.get(key)
+            if table is not None and table.version == self.env.version:
+                return table
+            self._tables.pop(key, None)
+            needed = AllPairsTable.nbytes_for(self.graph.total_nodes)
+            if needed > self.table_budget_bytes:
+                return None
+            # Evict other profiles until the new table fits
+            while self._tables and needed * (len(self._tables) + 1) > self.table_budget_bytes:
+                self._tables.pop(next(iter(self._tables)))
+            costs, _ = self.edge_costs(vehicle_type, priority)
+            table = AllPairsTable(self.graph, np.asarray(costs), self.env.version)
+            self._tables[key] = table
+            return table
+
+    def route_matrices(
+        self, sources: np.ndarray, targets: np.ndarray, vehicle_type: str, priority: str
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Least routing cost from every source node to every target node (inf if unreachable),
+        and the road length in metres of each of those least-cost routes.
+
+        Reads the all-pairs table when it fits the budget; otherwise grows one
+        Dijkstra tree per distinct source, or per distinct target over reversed
+        edges when there are fewer of those.
+        """
+        table = self.all_pairs_table(vehicle_type, priority)
+        if table is not None:
+            block = np.ix_(sources, targets)
+            return table.dist[block], table.length[block]
+        costs, _ = self.edge_costs(vehicle_type, priority)
+        return self._tree_matrix(sources, targets, costs)
+
+    def _tree_matrix(self, sources: np.ndarray, targets: np.ndarray, weights: List[float]) -> Tuple[np.ndarray, np.ndarray]:
+        src, src_inv = np.unique(sources, return_inverse=True)
+        dst, dst_inv = np.unique(targets, return_inverse=True)
+        lengths = self.graph.distances.tolist()
+        if len(dst) < len(src):
+            # Edge e's reverse carries the weight of travelling it backwards
+            reverse_weights = np.asarray(weights)[self.graph.reverse_edges].tolist()
+            trees = [self._tree(root, reverse_weights, lengths) for root in dst]
+            cost = np.array([np.asarray(dist)[src] for dist, _ in trees]).T
+            length = np.array([np.asarray(metres)[src] for _, metres in trees]).T
+        else:
+            trees = [self._tree(root, weights, lengths) for root in src]
+            cost = np.array([np.asarray(dist)[dst] for dist, _ in trees])
+            length = np.array([np.asarray(metres)[dst] for _, metres in trees])
+        pick = np.ix_(src_inv, dst_inv)
+        return cost.reshape(len(src), len(dst))[pick], length.reshape(len(src), len(dst))[pick]
+
+    def _tree(self, root: int, weights: List[float], lengths: List[float]) -> Tuple[List[float], List[float]]:
+        """Full single-source Dijkstra; returns the cost to every node and the length of that route."""
+        offsets, targets = self.graph.offsets_list, self.graph.targets_list
+        dist = [math.inf] * self.graph.total_nodes
+        metres = [math.inf] * self.graph.total_nodes
+        dist[root] = 0.0
+        metres[root] = 0.0
+        pq = [(0.0, root)]
         while pq:
             d, u = heapq.heappop(pq)
             if d > dist[u]:
                 continue
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                new_dist = d + weights[e]
+                if new_dist < dist[v]:
+                    dist[v] = new_dist
+                    metres[v] = metres[u] + lengths[e]
+                    heapq.heappush(pq, (new_dist, v))
+        return dist, metres
+
+    def _labels(self, name: str) -> SearchLabels:
+        labels = getattr(self._local, name, None)
+        if labels is None:
+            labels = SearchLabels(self.graph.total_nodes)
+            setattr(self._local, name, labels)
+        labels.reset()
+        return labels
+
+    def _astar(self, start: int, goal: int, costs: List[float], per_metre: float) -> Tuple[Optional[List[int]], int]:
+        """A* over the CSR adjacency; per_metre = 0 makes it plain Dijkstra."""
+        offsets, targets = self.graph.offsets_list, self.graph.targets_list
+        xs, ys = self._xs, self._ys
+        gx, gy = xs[goal], ys[goal]
+        labels = self._labels("forward")
+        dist, stamp, prev, generation = labels.dist, labels.stamp, labels.prev, labels.generation
+
+        labels.set(start, 0.0, -1)
+        pq = [(0.0, 0.0, start)]
+        settled = 0
+        while pq:
+            _, d, u = heapq.heappop(pq)
+            if d > dist[u]:
+                continue
+            settled += 1
             if u == goal:
-                break
+                return labels.path_to(goal), settled
 
-            for v in self.graph.get_neighbors(u):
-                edge = self.graph.get_edge(u, v)
-                if not edge:
-                    continue
-                tf = self.env.get_traffic_factor(u, v)
-                wi = self.env.get_weather_impact(v)
-                flood_penalty = 500 if self.env.is_flooded(v) else 0
-
-                time_cost = edge["distance"] * 0.002 * tf * wi
-                fuel_cost = edge["distance"] * 0.00025 * mult * tf * wi
-
-                if priority in ("critical", "high"):
-                    cost = time_cost + flood_penalty
-                elif priority == "low":
-                    cost = fuel_cost * 2 + flood_penalty
-                else:
-                    cost = fuel_cost * 5 + time_cost * 2 + flood_penalty
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                new_dist = d + costs[e]
+                if stamp[v] != generation or new_dist < dist[v]:
+                    dist[v] = new_dist
+                    prev[v] = u
+                    stamp[v] = generation
+                    h = per_metre * math.hypot(xs[v] - gx, ys[v] - gy) if per_metre else 0.0
+                    heapq.heappush(pq, (new_dist + h, new_dist, v))
+        return None, settled
 
-                new_dist = dist[u] + cost
-                if new_dist < dist[v]:
+    def _time_dependent(self, start: int, goal: int, vehicle_type: str, priority: str) -> Tuple[Optional[List[int]], int]:
+        """Dijkstra where each edge is costed at the forecast step its tail is reached.
+
+        Labels carry the elapsed travel time alongside the cost; steps beyond
+        the horizon reuse the last forecast row.
+        """
+        offsets, targets = self.graph.offsets_list, self.graph.targets_list
+        labels = self._labels("forward")
+        dist, stamp, prev, generation = labels.dist, labels.stamp, labels.prev, labels.generation
+        rows: Dict[int, Tuple[List[float], List[float]]] = {}
+
+        labels.set(start, 0.0, -1)
+        pq = [(0.0, 0.0, start)]
+        settled = 0
+        while pq:
+            d, elapsed, u = heapq.heappop(pq)
+            if d > dist[u]:
+                continue
+            settled += 1
+            if u == goal:
+                return labels.path_to(goal), settled
+
+            step = min(FORECAST_HORIZON, int(elapsed / FORECAST_STEP_TIME))
+            if step not in rows:
+                rows[step] = self.forecast_edge_costs(vehicle_type, priority, step)
+            costs, times = rows[step]
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                new_dist = d + costs[e]
+                if stamp[v] != generation or new_dist < dist[v]:
                     dist[v] = new_dist
                     prev[v] = u
+                    stamp[v] = generation
+                    heapq.heappush(pq, (new_dist, elapsed + times[e], v))
+        return None, settled
+
+    def _bidirectional(self, start: int, goal: int, costs: List[float]) -> Tuple[Optional[List[int]], int]:
+        """Dijkstra from both ends; the backward search follows edges in reverse."""
+        if start == goal:
+            return [start], 0
+        offsets, targets, reverse = self.graph.offsets_list, self.graph.targets_list, self._reverse
+        fwd = self._labels("forward")
+        bwd = self._labels("backward")
+        fwd.set(start, 0.0, -1)
+        bwd.set(goal, 0.0, -1)
+        fwd_pq = [(0.0, start)]
+        bwd_pq = [(0.0, goal)]
+        best = math.inf
+        meet = -1
+        settled = 0
+
+        while fwd_pq and bwd_pq:
+            if fwd_pq[0][0] + bwd_pq[0][0] >= best:
+                break
+            forward = fwd_pq[0][0] <= bwd_pq[0][0]
+            labels, other, pq = (fwd, bwd, fwd_pq) if forward else (bwd, fwd, bwd_pq)
+            d, u = heapq.heappop(pq)
+            if d > labels.dist[u]:
+                continue
+            settled += 1
+
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                new_dist = d + (costs[e] if forward else costs[reverse[e]])
+                if not labels.reached(v) or new_dist < labels.dist[v]:
+                    labels.set(v, new_dist, u)
                     heapq.heappush(pq, (new_dist, v))
+                if other.reached(v) and labels.dist[v] + other.dist[v] < best:
+                    best = labels.dist[v] + other.dist[v]
+                    meet = v
 
-        # Reconstruct path
-        path = []
-        node = goal
-        while node is not None:
+        if meet < 0:
+            return None, settled
+        path = fwd.path_to(meet)
+        node = bwd.prev[meet]
+        while node != -1:
             path.append(node)
-            node = prev[node]
-        path.reverse()
+            node = bwd.prev[node]
+        return path, settled
+
+    def _find_route(self, start: int, goal: int, vehicle_type: str, priority: str, algorithm: str) -> dict:
+        with metrics.timer("greenpath_router_seconds", algorithm=algorithm):
+            result = self._search(start, goal, vehicle_type, priority, algorithm)
+        metrics.inc("greenpath_router_nodes_settled_total", result["nodes_settled"], algorithm=algorithm)
+        return result
+
+    def _search(self, start: int, goal: int, vehicle_type: str, priority: str, algorithm: str) -> dict:
+        costs, per_metre = self.edge_costs(vehicle_type, priority)
+        if algorithm == "bidirectional":
+            path, settled = self._bidirectional(start, goal, costs)
+        elif algorithm == "incremental":
+            path, settled = self._incremental(start, goal, vehicle_type, priority, costs)
+        elif algorithm == "table":
+            table = self.all_pairs_table(vehicle_type, priority)
+            if table is None:
+                algorithm = "dijkstra"
+                path, settled = self._astar(start, goal, costs, 0.0)
+            else:
+                path, settled = table.path(start, goal), 0
+        elif algorithm == "time_dependent":
+            path, settled = self._time_dependent(start, goal, vehicle_type, priority)
+            return self._route_result(
+                start, goal, path, vehicle_type, ROUTING_ALGORITHMS[algorithm], settled, forecast=True
+            )
+        else:
+            path, settled = self._astar(start, goal, costs, per_metre if algorithm == "astar" else 0.0)
+        return self._route_result(start, goal, path, vehicle_type, ROUTING_ALGORITHMS[algorithm], settled)
+
+    def find_routes_from(self, start: int, goals: List[int], vehicle_type: str, priority: str) -> List[dict]:
+        """Routes from one origin to many goals with a single shortest-path tree.
+
+        The Dijkstra search stops once every requested goal is settled; each
+        result reports the size of the shared tree as nodes_settled.
+        """
+        costs, _ = self.edge_costs(vehicle_type, priority)
+        offsets, targets = self.graph.offsets_list, self.graph.targets_list
+        labels = self._labels("forward")
+        dist, stamp, prev, generation = labels.dist, labels.stamp, labels.prev, labels.generation
+
+        remaining = set(goals)
+        labels.set(start, 0.0, -1)
+        pq = [(0.0, start)]
+        settled = 0
+        while pq and remaining:
+            d, u = heapq.heappop(pq)
+            if d > dist[u]:
+                continue
+            settled += 1
+            remaining.discard(u)
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                new_dist = d + costs[e]
+                if stamp[v] != generation or new_dist < dist[v]:
+                    dist[v] = new_dist
+                    prev[v] = u
+                    stamp[v] = generation
+                    heapq.heappush(pq, (new_dist, v))
+
+        metrics.inc("greenpath_router_nodes_settled_total", settled, algorithm="tree")
+        paths = [labels.path_to(goal) if labels.reached(goal) else None for goal in goals]
+        return self._route_results(start, goals, paths, vehicle_type, "Dijkstra", settled)
+
+    def _route_result(
+        self, start: int, goal: int, path: Optional[List[int]], vehicle_type: str, algorithm: str, settled: int,
+        forecast: bool = False
+    ) -> dict:
+        """Per-segment metrics for `path`; with `forecast`, each segment uses the forecast step it starts in."""
+        return self._route_results(start, [goal], [path], vehicle_type, algorithm, settled, forecast)[0]
+
+    def _route_results(
+        self, start: int, goals: List[int], paths: List[Optional[List[int]]], vehicle_type: str, algorithm: str,
+        settled: int, forecast: bool = False
+    ) -> List[dict]:
+        found = [i for i, path in enumerate(paths) if path]
+        evaluated = self.evaluator.evaluate_many([paths[i] for i in found], vehicle_type, forecast=forecast)
+        results: List[dict] = [{
+            "path": [start, goal],
+            "steps": [],
+            "total_fuel": 0,
+            "total_time": 0,
+            "total_distance": 0,
+            "co2_emissions": 0,
+        } for goal in goals]
+        for i, result in zip(found, evaluated):
+            results[i] = result
+        for result in results:
+            result["algorithm"] = algorithm
+            result["nodes_settled"] = settled
+        return results
+
+
+# ============================================================
+# Simulation History
+# ============================================================
+
+HISTORY_CAPACITY = int(os.environ.get("GREENPATH_HISTORY_CAPACITY", "1000"))
+
+
+class HistoryStore:
+    """Fixed-capacity ring buffer of run records.
+
+    Ids are assigned sequentially from 1; only the newest `capacity` runs are
+    retained, while the aggregates cover every run ever recorded.
+    """
+
+    def __init__(self, capacity: int = HISTORY_CAPACITY, log: Optional["HistoryLog"] = None):
+        self.capacity = capacity
+        self._runs: List[Optional[dict]] = [None] * capacity
+        self.total = 0
+        self.rl_wins = 0
+        self.training_time_sum = 0.0
+        self._lock = threading.RLock()
+        self.log = log
+        self._loaded = log is None
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return self.total
 
-        if not path or path[0] != start:
+    def _ensure_loaded(self):
+        """Restores aggregates and the newest runs from the log on first use."""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self.total, self.rl_wins, self.training_time_sum, recent = self.log.load(self.capacity)
+            for record in recent:
+                self._runs[(record["id"] - 1) % self.capacity] = record
+            self._loaded = True
+
+    @property
+    def oldest_id(self) -> int:
+        return max(1, self.total - self.capacity + 1)
+
+    def append(self, record: dict) -> dict:
+        self._ensure_loaded()
+        with self._lock:
+            self.total += 1
+            record = {"id": self.total, **record}
+            self._runs[(self.total - 1) % self.capacity] = record
+            rl_win = record["rl"]["total_fuel"] < record["dijkstra"]["total_fuel"]
+            if rl_win:
+                self.rl_wins += 1
+            self.training_time_sum += record["training_time_ms"]
+            if self.log is not None:
+                self.log.append(record, rl_win)
+        return record
+
+    def page(self, limit: int, cursor: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+        """Returns up to `limit` runs newest-first with ids below `cursor`, plus the next cursor."""
+        self._ensure_loaded()
+        with self._lock:
+            newest = self.total if cursor is None else min(cursor - 1, self.total)
+            oldest = max(self.oldest_id, newest - limit + 1)
+            runs = [self._runs[(run_id - 1) % self.capacity] for run_id in range(newest, oldest - 1, -1)]
+            next_cursor = oldest if runs and oldest > self.oldest_id else None
+        return runs, next_cursor
+
+    def aggregates(self) -> dict:
+        self._ensure_loaded()
+        with self._lock:
+            total = self.total
             return {
-                "path": [start, goal],
-                "steps": [],
-                "total_fuel": 0,
-                "total_time": 0,
-                "total_distance": 0,
-                "co2_emissions": 0,
-                "algorithm": "Dijkstra"
+                "total_simulations": total,
+                "rl_wins": self.rl_wins,
+                "dijkstra_wins": total - self.rl_wins,
+                "rl_win_rate": round(self.rl_wins / total * 100, 1) if total > 0 else 0,
+                "avg_training_time_ms": round(self.training_time_sum / total, 1) if total > 0 else 0,
             }
 
-        # Calculate metrics
-        steps = []
-        total_fuel = 0.0
-        total_time = 0.0
-        total_distance = 0.0
 
-        for i in range(len(path) - 1):
-            edge = self.graph.get_edge(path[i], path[i + 1])
-            if not edge:
+# ============================================================
+# Persistence
+# ============================================================
+
+# Snapshots and the history log live here; unset disables persistence
+STATE_DIR = os.environ.get("GREENPATH_STATE_DIR")
+
+
+def save_array(path: str, array: np.ndarray):
+    """np.save via a temp file and rename, so readers never map a half-written file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(tmp_path, path)
+
+
+class HistoryLog:
+    """Append-only SQLite log of run records in WAL mode, shareable by several worker processes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL, rl_win INTEGER, "
+            "training_time_ms REAL, record TEXT)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def append(self, record: dict, rl_win: bool):
+        self._connect().execute(
+            "INSERT INTO runs (timestamp, rl_win, training_time_ms, record) VALUES (?, ?, ?, ?)",
+            (record["timestamp"], int(rl_win), record["training_time_ms"], json.dumps(record))
+        )
+
+    def load(self, limit: int) -> Tuple[int, int, float, List[dict]]:
+        """Returns (total runs, RL wins, training time sum, newest `limit` records oldest-first)."""
+        conn = self._connect()
+        total, rl_wins, time_sum = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(rl_win), 0), COALESCE(SUM(training_time_ms), 0) FROM runs"
+        ).fetchone()
+        rows = conn.execute("SELECT record FROM runs ORDER BY seq DESC LIMIT ?", (limit,)).fetchall()
+        recent = [json.loads(row[0]) for row in reversed(rows)]
+        # Renumber so ids stay contiguous even if several workers appended concurrently
+        for i, record in enumerate(recent):
+            record["id"] = total - len(recent) + 1 + i
+        return total, rl_wins, time_sum, recent
+
+
+def save_state(directory: str) -> dict:
+    """Snapshots the graph, environment and (dense) Q-tables for a fast warm start.
+
+    The environment is saved with the tables because they were trained for
+    its conditions. Per-goal tables go to q_tables/goal_<id>, listed least
+    recent first in q_tables/goals.json; a table not trained for any goal goes
+    to q_table.
+    """
+    with state_lock:
+        environment = env.snapshot()
+        q_table = rl_agent.q_table
+        goal_tables = list(rl_agent.goal_tables.items())
+    city.save(os.path.join(directory, "graph"))
+    environment.save(os.path.join(directory, "environment"))
+    goal_tables = [(goal, table) for goal, table in goal_tables if isinstance(table, DenseQTable)]
+    tables_dir = os.path.join(directory, "q_tables")
+    for goal, table in goal_tables:
+        table.save(os.path.join(tables_dir, f"goal_{goal}"))
+    os.makedirs(tables_dir, exist_ok=True)
+    index_path = os.path.join(tables_dir, "goals.json")
+    with open(f"{index_path}.{os.getpid()}.tmp", "w") as f:
+        json.dump([goal for goal, _ in goal_tables], f)
+    os.replace(f"{index_path}.{os.getpid()}.tmp", index_path)
+    kept = {f"goal_{goal}" for goal, _ in goal_tables}
+    for name in os.listdir(tables_dir):
+        if name.startswith("goal_") and name not in kept:
+            shutil.rmtree(os.path.join(tables_dir, name), ignore_errors=True)
+    saved_q = isinstance(q_table, DenseQTable) and all(q_table is not table for _, table in goal_tables)
+    if saved_q:
+        q_table.save(os.path.join(directory, "q_table"))
+    return {
+        "directory": directory, "graph_edges": city.num_edges,
+        "q_table_saved": saved_q, "goal_tables_saved": len(goal_tables),
+    }
+
+
+def load_q_tables(agent: "QLearningAgent", directory: str):
+    """Restores what save_state wrote: the per-goal tables, else a goal-less table."""
+    agent.q_table = DenseQTable.load(agent.graph, os.path.join(directory, "q_table")) or agent.q_table
+    tables_dir = os.path.join(directory, "q_tables")
+    index_path = os.path.join(tables_dir, "goals.json")
+    if not os.path.exists(index_path):
+        return
+    with open(index_path) as f:
+        goals = json.load(f)
+    for goal in goals:
+        table = DenseQTable.load(agent.graph, os.path.join(tables_dir, f"goal_{goal}"))
+        if table is not None and 0 <= goal < agent.graph.total_nodes:
+            agent.publish(table, goal)
+
+
+def load_graph() -> CityGraph:
+    if STATE_DIR:
+        graph = CityGraph.load(os.path.join(STATE_DIR, "graph"))
+        if graph is not None:
+            return graph
+    if GRAPH_PATH:
+        return CityGraph.from_edge_list(GRAPH_PATH)
+    return CityGraph(GRID_SIZE)
+
+
+def load_history() -> HistoryStore:
+    if STATE_DIR:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        return HistoryStore(log=HistoryLog(os.path.join(STATE_DIR, "history.db")))
+    return HistoryStore()
+
+
+# ============================================================
+# Fleet Dispatch
+# ============================================================
+
+FLEET_SIZE = int(os.environ.get("GREENPATH_FLEET_SIZE", "5"))
+# Cheapest columns each row bids on in solve_assignment
+ASSIGNMENT_CANDIDATES = 32
+CHARGE_KM_PER_STEP = 25.0
+
+
+def _auction(benefit: np.ndarray, index: np.ndarray, num_objects: int, eps: float, eps_final: float) -> np.ndarray:
+    """Jacobi auction with epsilon scaling: row i may take object index[i, k] for benefit[i, k].
+
+    All free rows bid at once; each object goes to its highest bidder. The
+    problem is made square with num_objects - rows identical zero-benefit
+    bidders, so every object is owned at the end of each phase and prices
+    carried between phases stay valid. Those bidders need no rows of their
+    own: a group of r free ones takes the r cheapest objects at the
+    (r+1)-th cheapest price.
+    """
+    n = len(benefit)
+    spare = num_objects - n
+    prices = np.zeros(num_objects)
+    assigned = np.full(n, -1, dtype=np.int64)
+    while True:
+        owner = np.full(num_objects, -1, dtype=np.int64)
+        assigned[:] = -1
+        free = np.arange(n)
+        free_spare = spare
+        while len(free) or free_spare:
+            if len(free) == 1 and not free_spare:
+                # A lone bidder (the common tail) needs no conflict resolution
+                row = free[0]
+                values = benefit[row] - prices[index[row]]
+                best = int(values.argmax())
+                best_val = values[best]
+                values[best] = -np.inf
+                second = values.max()
+                obj = index[row, best]
+                prices[obj] += best_val - (second if np.isfinite(second) else best_val) + eps
+                outbid = owner[obj]
+                owner[obj] = row
+                assigned[row] = obj
+                free = free[:0] if outbid < 0 or outbid == n else np.array([outbid])
+                free_spare += int(outbid == n)
                 continue
-            tf = self.env.get_traffic_factor(path[i], path[i + 1])
-            wi = self.env.get_weather_impact(path[i + 1])
-            seg_fuel = (edge["distance"] * 0.00025 + max(0, edge["elevation"] * 0.0001)) * mult * tf * wi
-            seg_time = edge["distance"] * 0.002 * tf * wi
-
-            total_fuel += seg_fuel
-            total_time += seg_time
-            total_distance += edge["distance"]
-
-            steps.append({
-                "node": path[i + 1],
-                "traffic_level": round(tf, 3),
-                "weather_condition": "rainy" if wi > 1.2 else "clear",
-                "fuel_cost": round(seg_fuel, 5),
-                "time_cost": round(seg_time, 3),
-                "reason": None
-            })
 
-        co2 = total_fuel * get_co2_factor(vehicle_type)
+            values = benefit[free] - prices[index[free]]
+            rows = np.arange(len(free))
+            best = values.argmax(axis=1)
+            best_val = values[rows, best]
+            values[rows, best] = -np.inf
+            second = values.max(axis=1)
+            second = np.where(np.isfinite(second), second, best_val)
+            wanted = index[free, best]
+            bids = prices[wanted] + best_val - second + eps
+            bidders = free
+            if free_spare:
+                # Spare bidders are interchangeable, so they never outbid each other
+                open_prices = np.where(owner == n, np.inf, prices)
+                cheapest = np.argpartition(open_prices, free_spare)[:free_spare + 1]
+                cheapest = cheapest[np.argsort(open_prices[cheapest])]
+                ceiling = open_prices[cheapest[free_spare]]
+                wanted = np.concatenate([wanted, cheapest[:free_spare]])
+                bids = np.concatenate([bids, np.full(free_spare, ceiling + eps)])
+                bidders = np.concatenate([bidders, np.full(free_spare, n)])
+
+            order = np.lexsort((-bids, wanted))
+            objs, first = np.unique(wanted[order], return_index=True)
+            winners = bidders[order[first]]
+            outbid = owner[objs]
+            assigned[outbid[(outbid >= 0) & (outbid < n)]] = -1
+            free_spare += int((outbid == n).sum()) - int((winners == n).sum())
+            owner[objs] = winners
+            real = winners < n
+            assigned[winners[real]] = objs[real]
+            prices[objs] = bids[order[first]]
+            free = np.nonzero(assigned < 0)[0]
+        if eps <= eps_final:
+            return assigned
+        eps = max(eps / 5, eps_final)
+
+
+def solve_assignment(cost: np.ndarray, candidates: int = ASSIGNMENT_CANDIDATES) -> np.ndarray:
+    """Min-cost matching of rows to distinct columns; inf marks forbidden pairs.
+
+    As many rows as possible are matched, at least total cost among those
+    matchings. Each row bids on its `candidates` cheapest columns plus a
+    private "unassigned" slot priced above any matching that serves one row
+    more; rows left over are retried against the columns still free, so with
+    a cap the cost may exceed the optimum. Returns the column per row, or -1.
+    """
+    result = np.full(cost.shape[0], -1, dtype=np.int64)
+    rows, cols = np.arange(cost.shape[0]), np.arange(cost.shape[1])
+    while len(rows) and len(cols):
+        sub = cost[np.ix_(rows, cols)]
+        k = min(candidates, len(cols))
+        cand = np.argpartition(sub, k - 1, axis=1)[:, :k]
+        cand_cost = np.take_along_axis(sub, cand, axis=1)
+        finite = np.isfinite(cand_cost)
+        if not finite.any():
+            break
+        spread = float(cand_cost[finite].max() - cand_cost[finite].min()) or 1.0
+        # Dearer than any reshuffle that frees a column, so no row is left out to save cost
+        penalty = float(cand_cost[finite].max()) + (len(rows) + 1) * spread
+        benefit = np.concatenate(
+            [np.where(finite, -cand_cost, -np.inf), np.full((len(rows), 1), -penalty)], axis=1
+        )
+        index = np.concatenate([cand, len(cols) + np.arange(len(rows))[:, None]], axis=1)
+        picked = _auction(benefit, index, len(cols) + len(rows), spread / 4, spread * 1e-3 / (len(cols) + len(rows)))
+
+        real = picked < len(cols)
+        if not real.any():
+            break
+        result[rows[real]] = cols[picked[real]]
+        taken = np.zeros(len(cols), dtype=bool)
+        taken[picked[real]] = True
+        rows, cols = rows[~real], cols[~taken]
+        if len(cols):
+            rows = rows[np.isfinite(cost[np.ix_(rows, cols)]).any(axis=1)]
+    return result
+
+
+class Fleet:
+    """Vehicle state held as parallel arrays; current_range is in km and only tracked for EVs."""
+
+    def __init__(self, ids: List[str], types: List[str], locations: List[int], ranges: List[float],
+                 max_ranges: List[float], statuses: List[str], stress: Optional[List[float]] = None):
+        self.ids = list(ids)
+        self.types = np.array(types, dtype=object)
+        self.locations = np.array(locations, dtype=np.int64)
+        self.current_range = np.array(ranges, dtype=np.float64)
+        self.max_range = np.array(max_ranges, dtype=np.float64)
+        self.status = np.array(statuses, dtype=object)
+        # Driver stress, 0-10
+        self.stress = np.zeros(len(self.ids)) if stress is None else np.array(stress, dtype=np.float64)
+        self.lock = threading.Lock()
+        # (vehicle order, locations in that order) sorted by location; reset whenever vehicles move
+        self._by_location: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    @classmethod
+    def generate(cls, count: int, graph: CityGraph) -> "Fleet":
+        ranges = [float(random.randint(50, 300)) for _ in range(count)]
+        return cls(
+            ids=[f"VH-{100 + i}" for i in range(count)],
+            types=["ev" if i % 2 == 0 else "petrol" for i in range(count)],
+            locations=[random.randint(0, graph.total_nodes - 1) for _ in range(count)],
+            ranges=ranges,
+            max_ranges=[max(300.0, r) for r in ranges],
+            statuses=[random.choice(["idle", "en-route", "charging"]) for _ in range(count)],
+            stress=[round(random.random() * 10, 1) for _ in range(count)],
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def to_list(self, indices: Optional[np.ndarray] = None) -> List[dict]:
+        return [
+            {
+                "id": self.ids[i],
+                "type": self.types[i],
+                "location": int(self.locations[i]),
+                "status": self.status[i],
+                "current_range": round(float(self.current_range[i]), 1),
+                "max_range": float(self.max_range[i]),
+                "stress_index": round(float(self.stress[i]), 1),
+            }
+            for i in (range(len(self.ids)) if indices is None else indices.tolist())
+        ]
+
+    def nearby(self, index: SpatialIndex, point: Tuple[float, float], radius: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Vehicles within `radius` metres of `point`, nearest first, as (vehicle indices, distances).
+
+        The spatial index finds the nodes in range; vehicles at those nodes are
+        found by binary search over the fleet sorted by location.
+        """
+        _, nodes, dist = index.within([point], radius)
+        with self.lock:
+            if self._by_location is None:
+                order = np.argsort(self.locations, kind="stable")
+                self._by_location = (order, self.locations[order])
+            order, located = self._by_location
+        lo = np.searchsorted(located, nodes, side="left")
+        counts = np.searchsorted(located, nodes, side="right") - lo
+        first = np.cumsum(counts) - counts
+        positions = np.arange(int(counts.sum())) + np.repeat(lo - first, counts)
+        return order[positions], np.repeat(dist, counts)
+
+    def step(self):
+        """En-route vehicles arrive; charging EVs gain range and go idle once full."""
+        with self.lock:
+            self.status[self.status == "en-route"] = "idle"
+            charging = self.status == "charging"
+            self.current_range[charging] = np.minimum(
+                self.current_range[charging] + CHARGE_KM_PER_STEP, self.max_range[charging]
+            )
+            self.status[charging & (self.current_range >= self.max_range)] = "idle"
+
+    def dispatch(
+        self, router: "DijkstraRouter", pickups: np.ndarray, dropoffs: np.ndarray, priorities: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Assigns jobs to idle vehicles at least total routing cost and moves the chosen vehicles.
+
+        A vehicle's cost for a job is the route cost to the pickup plus the
+        pickup-to-dropoff leg, under the vehicle's type and the job's priority.
+        EVs are eligible only if the length of the least-cost routes they would
+        drive for the whole trip fits their current range. Returns per job the vehicle index (-1 if
+        unassigned), cost, trip km, and whether any idle vehicle could serve it.
+        """
+        with self.lock:
+            idle = np.nonzero(self.status == "idle")[0]
+            locations = self.locations[idle]
+            types = self.types[idle]
 
+            cost = np.empty((len(idle), len(pickups)))
+            trip_km = np.empty((len(idle), len(pickups)))
+            for vehicle_type in np.unique(types):
+                v_rows = np.nonzero(types == vehicle_type)[0]
+                for priority in np.unique(priorities):
+                    j_cols = np.nonzero(priorities == priority)[0]
+                    p_src, p_inv = np.unique(pickups[j_cols], return_inverse=True)
+                    d_src, d_inv = np.unique(dropoffs[j_cols], return_inverse=True)
+                    leg, leg_m = router.route_matrices(p_src, d_src, vehicle_type, priority)
+                    approach, approach_m = router.route_matrices(locations[v_rows], pickups[j_cols], vehicle_type, priority)
+                    block = np.ix_(v_rows, j_cols)
+                    cost[block] = approach + leg[p_inv, d_inv]
+                    trip_km[block] = (approach_m + leg_m[p_inv, d_inv]) / 1000
+            out_of_range = (types == "ev")[:, None] & (trip_km > self.current_range[idle][:, None])
+            cost[out_of_range] = np.inf
+            feasible = np.isfinite(cost).any(axis=0)
+
+            vehicle = solve_assignment(cost.T)
+            jobs = np.nonzero(vehicle >= 0)[0]
+            rows = vehicle[jobs]
+            job_cost = np.full(len(pickups), np.nan)
+            job_km = np.full(len(pickups), np.nan)
+            job_cost[jobs] = cost[rows, jobs]
+            job_km[jobs] = trip_km[rows, jobs]
+
+            chosen = idle[rows]
+            vehicle[jobs] = chosen
+            self.locations[chosen] = dropoffs[jobs]
+            self._by_location = None
+            self.status[chosen] = "en-route"
+            ev = self.types[chosen] == "ev"
+            self.current_range[chosen[ev]] = np.maximum(0.0, self.current_range[chosen[ev]] - job_km[jobs][ev])
+            return vehicle, job_cost, job_km, feasible
+
+
+# ============================================================
+# Shared World
+# ============================================================
+
+# Name prefix for shared-memory segments; when set, every worker process routes
+# against one graph, environment and set of per-goal dense Q-tables
+SHARED_WORLD = os.environ.get("GREENPATH_SHARED_WORLD")
+# Traffic arrays are written round-robin, so one a reader holds stays intact for this many pushes
+SHARED_TRAFFIC_SLOTS = 8
+SHARED_MAX_WORKERS = 256
+# Header fields: seqlock counter (odd while a write is in progress), environment
+# version, live traffic slot, rain (stored as float64), Q-table publish stamp and
+# the number of pushes so far
+HEADER_SEQ, HEADER_VERSION, HEADER_SLOT, HEADER_RAIN, HEADER_Q_STAMP, HEADER_PUSHES = range(6)
+
+
+def _open_segment(name: str, size: int = 0) -> shared_memory.SharedMemory:
+    segment = shared_memory.SharedMemory(name=name, create=size > 0, size=size)
+    # The world outlives whichever worker created it; the last worker to leave unlinks it
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def _unlink_segment(segment: shared_memory.SharedMemory):
+    # unlink() also unregisters the segment, so register it again first
+    resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedWorld:
+    """The graph, live environment and trained dense Q-tables in POSIX shared memory.
+
+    Workers map every segment and use the arrays in place. Writes are
+    serialized by an flock on a lock file: the writer pulls the latest state,
+    changes its Environment and pushes it. A push copies traffic into the next
+    slot of a ring and then updates the header under a seqlock, so readers
+    never block and adopt a newer version by pointing their Environment at
+    the slot. Published Q-tables go into the least recently published table
+    slot the same way. Forecast noise, scenarios and the fleet stay per worker.
+    """
+
+    def __init__(self, prefix: str, manifest: dict, segments: Dict[str, shared_memory.SharedMemory], lock_file):
+        self.prefix = prefix
+        self.segments = segments
+        self.lock_file = lock_file
+        self.arrays = self._arrays(manifest, segments)
+        # Readers get read-only views; only push() and publish_table() write, through the arrays themselves
+        views = {name: array.view() for name, array in self.arrays.items()}
+        for view in views.values():
+            view.flags.writeable = False
+        self.graph = CityGraph.from_arrays(views, manifest["grid_size"])
+        self.header = self.arrays["header"]
+        self.header_floats = self.header.view(np.float64)
+        self.traffic = views["traffic"]
+        self.q_values = views.get("q_values")
+        self.q_visited = views.get("q_visited")
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._tables_seen = 0
+        # Push count when the local environment last pointed at a traffic slot
+        self._pushes_seen = 0
+        # goal -> (slot, publish stamp, table view) for tables handed to the local agent
+        self._adopted: Dict[int, tuple] = {}
+
+    @staticmethod
+    def _arrays(manifest: dict, segments: Dict[str, shared_memory.SharedMemory]) -> Dict[str, np.ndarray]:
         return {
-            "path": path,
-            "steps": steps,
-            "total_fuel": round(total_fuel, 5),
-            "total_time": round(total_time, 3),
-            "total_distance": round(total_distance, 2),
-            "co2_emissions": round(co2, 5),
-            "algorithm": "Dijkstra"
+            name: np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=segments[name].buf)
+            for name, (dtype, shape) in manifest["arrays"].items()
         }
 
+    @classmethod
+    def open(cls, prefix: str, build_graph) -> "SharedWorld":
+        """Joins the world named `prefix`, creating it from build_graph() if no live worker holds one."""
+        if fcntl is None:
+            raise RuntimeError("GREENPATH_SHARED_WORLD needs POSIX shared memory and file locks")
+        lock_file = open(os.path.join(tempfile.gettempdir(), f"{prefix}.lock"), "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            manifest, segments = cls._attach(prefix)
+            if manifest is not None:
+                workers = cls._arrays(manifest, segments)["workers"]
+                if not any(_pid_alive(pid) for pid in workers[workers > 0].tolist()):
+                    # Left behind by workers that died without detaching
+                    cls._unlink(prefix, segments)
+                    manifest = None
+            if manifest is None:
+                manifest, segments = cls._create(prefix, build_graph())
+            world = cls(prefix, manifest, segments, lock_file)
+            world._join()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return world
+
+    @staticmethod
+    def _attach(prefix: str) -> tuple:
+        try:
+            segment = _open_segment(f"{prefix}_manifest")
+        except FileNotFoundError:
+            return None, None
+        length = int.from_bytes(segment.buf[:8], "little")
+        manifest = json.loads(bytes(segment.buf[8:8 + length]))
+        segments = {name: _open_segment(f"{prefix}_{name}") for name in manifest["arrays"]}
+        segments["manifest"] = segment
+        return manifest, segments
+
+    @staticmethod
+    def _create(prefix: str, graph: CityGraph) -> tuple:
+        specs = {name: (getattr(graph, name).dtype, getattr(graph, name).shape) for name in CityGraph.ARRAYS}
+        specs["header"] = (np.dtype(np.int64), (6,))
+        specs["workers"] = (np.dtype(np.int64), (SHARED_MAX_WORKERS,))
+        specs["traffic"] = (np.dtype(np.float64), (SHARED_TRAFFIC_SLOTS, graph.num_roads))
+        specs["flooded"] = (np.dtype(bool), (graph.total_nodes,))
+        if graph.node_ids is not None:
+            specs["node_ids"] = (graph.node_ids.dtype, graph.node_ids.shape)
+        if default_q_backend(graph) == "dense":
+            # One slot more than an agent keeps, so republishing a goal never overwrites its live table
+            slots = goal_table_limit(graph, "dense") + 1
+            specs["q_values"] = (np.dtype(np.float64), (slots, TRAFFIC_BUCKETS, len(WEATHER_LEVELS), graph.num_edges))
+            specs["q_visited"] = (np.dtype(bool), (slots, graph.total_nodes, TRAFFIC_BUCKETS, len(WEATHER_LEVELS)))
+            # (goal or -1, publish stamp) per table slot
+            specs["q_directory"] = (np.dtype(np.int64), (slots, 2))
+        manifest = {
+            "grid_size": graph.grid_size,
+            "arrays": {name: [dtype.str, list(shape)] for name, (dtype, shape) in specs.items()},
+        }
+        segments = {
+            name: _open_segment(f"{prefix}_{name}", max(dtype.itemsize * math.prod(shape), 1))
+            for name, (dtype, shape) in specs.items()
+        }
+        arrays = SharedWorld._arrays(manifest, segments)
+        for name in CityGraph.ARRAYS:
+            arrays[name][...] = getattr(graph, name)
+        if graph.node_ids is not None:
+            arrays["node_ids"][...] = graph.node_ids
+        # New segments are zero-filled; version -1 marks an environment nobody has pushed yet
+        arrays["header"][HEADER_VERSION] = -1
+        if "q_directory" in arrays:
+            arrays["q_directory"][:, 0] = -1
+        # The manifest goes last: its presence means the world is complete
+        payload = json.dumps(manifest).encode()
+        segment = _open_segment(f"{prefix}_manifest", 8 + len(payload))
+        segment.buf[:8] = len(payload).to_bytes(8, "little")
+        segment.buf[8:8 + len(payload)] = payload
+        segments["manifest"] = segment
+        return manifest, segments
+
+    @staticmethod
+    def _unlink(prefix: str, segments: Dict[str, shared_memory.SharedMemory]):
+        _unlink_segment(segments["manifest"])
+        for name, segment in segments.items():
+            if name != "manifest":
+                _unlink_segment(segment)
+
+    def _join(self):
+        workers = self.arrays["workers"]
+        live = [pid for pid in workers[workers > 0].tolist() if _pid_alive(pid)] + [os.getpid()]
+        if len(live) > SHARED_MAX_WORKERS:
+            raise RuntimeError(f"Shared world {self.prefix} already has {SHARED_MAX_WORKERS} workers")
+        workers[:] = 0
+        workers[:len(live)] = live
+
+    def close(self):
+        """Leaves the world; the last live worker unlinks its segments."""
+        with self.locked():
+            workers = self.arrays["workers"]
+            workers[workers == os.getpid()] = 0
+            if not any(_pid_alive(pid) for pid in workers[workers > 0].tolist()):
+                self._unlink(self.prefix, self.segments)
+
+    @contextmanager
+    def locked(self):
+        """Holds the single-writer lock across processes (and across this process's threads)."""
+        with self._thread_lock:
+            self._depth += 1
+            if self._depth == 1:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def start(self, environment: Environment, agent: QLearningAgent):
+        """Publishes `environment` if this is the world's first worker, else adopts the published one."""
+        with self.locked():
+            if self.header[HEADER_VERSION] < 0:
+                self.push(environment)
+            else:
+                self.pull(environment, agent, force=True)
+
+    def push(self, environment: Environment):
+        """Publishes `environment` as the latest state; the caller holds locked() and pulled first."""
+        traffic = self.arrays["traffic"]
+        slot = (int(self.header[HEADER_SLOT]) + 1) % len(traffic)
+        traffic[slot] = environment.traffic
+        flooded = self.arrays["flooded"]
+        self.header[HEADER_SEQ] += 1
+        flooded[:] = False
+        flooded[list(environment.flood_zones)] = True
+        self.header_floats[HEADER_RAIN] = environment.rain
+        self.header[HEADER_SLOT] = slot
+        self.header[HEADER_VERSION] = environment.version
+        self.header[HEADER_PUSHES] += 1
+        self.header[HEADER_SEQ] += 1
+        environment.traffic = self.traffic[slot]
+        self._pushes_seen = int(self.header[HEADER_PUSHES])
+
+    def pull(self, environment: Environment, agent: Optional[QLearningAgent] = None, force: bool = False):
+        """Adopts the published environment if it is newer than `environment`, and any newly published tables."""
+        directory = self.arrays.get("q_directory")
+        while True:
+            seq = int(self.header[HEADER_SEQ])
+            if seq % 2 == 0:
+                version = int(self.header[HEADER_VERSION])
+                slot = int(self.header[HEADER_SLOT])
+                rain = float(self.header_floats[HEADER_RAIN])
+                stamp = int(self.header[HEADER_Q_STAMP])
+                pushes = int(self.header[HEADER_PUSHES])
+                newer = force or version > environment.version
+                flooded = np.flatnonzero(self.arrays["flooded"]) if newer else None
+                tables = directory.copy() if agent is not None and directory is not None and stamp != self._tables_seen else None
+                if int(self.header[HEADER_SEQ]) == seq:
+                    break
+            time.sleep(0)
+        if newer:
+            self._adopt(environment, version, self.traffic[slot], rain, flooded, force, pushes)
+        elif version == environment.version and pushes != self._pushes_seen:
+            # Same state republished: follow it to the live slot before the ring recycles ours
+            environment.traffic = self.traffic[slot]
+            self._pushes_seen = pushes
+        if tables is not None:
+            self._tables_seen = stamp
+            self._adopt_tables(agent, tables)
+
+    def _adopt(self, environment: Environment, version: int, traffic: np.ndarray, rain: float, flooded: np.ndarray,
+               force: bool, pushes: int):
+        before_traffic, before_weather = environment.traffic, environment.weather_impacts()
+        # Once the ring has wrapped, the slot behind before_traffic holds a later push and can't be diffed
+        recycled = pushes - self._pushes_seen >= SHARED_TRAFFIC_SLOTS
+        self._pushes_seen = pushes
+        environment.traffic = traffic
+        environment.rain = rain
+        environment.flood_zones.clear()
+        environment.flood_zones.update(flooded.tolist())
+        skipped = version - environment.version - 1
+        if force or recycled or not 0 <= skipped < CHANGE_LOG_LENGTH:
+            environment.change_log.clear()
+            environment.version = version
+            return
+        # Log the net change under the new version so incremental consumers can still repair
+        empty = np.zeros(0, dtype=np.int64)
+        for missed in range(environment.version + 1, version):
+            environment.change_log.append((missed, empty, empty))
+        environment.version = version - 1
+        environment.record_change(
+            np.nonzero(traffic != before_traffic)[0],
+            np.nonzero(environment.weather_impacts() != before_weather)[0]
+        )
+
+    def _table(self, slot: int) -> DenseQTable:
+        table = DenseQTable.__new__(DenseQTable)
+        table.graph = self.graph
+        table.values = self.q_values[slot]
+        table.visited = self.q_visited[slot]
+        return table
+
+    def _adopt_tables(self, agent: QLearningAgent, directory: np.ndarray):
+        live = {goal: (slot, stamp) for slot, (goal, stamp) in enumerate(directory.tolist()) if goal >= 0}
+        for goal, (slot, stamp, table) in list(self._adopted.items()):
+            if live.get(goal) != (slot, stamp):
+                del self._adopted[goal]
+                if agent.goal_tables.get(goal) is table:
+                    del agent.goal_tables[goal]
+        for goal, (slot, stamp) in sorted(live.items(), key=lambda item: item[1][1]):
+            if goal not in self._adopted:
+                table = self._table(slot)
+                self._adopted[goal] = (slot, stamp, table)
+                agent._remember(goal, table)
+        agent.version += 1
+
+    def publish_table(self, goal: int, q_table) -> Optional[DenseQTable]:
+        """Copies a table trained for `goal` into the least recently published slot; returns its shared view.
+
+        Dict tables are not shared and return None.
+        """
+        directory = self.arrays.get("q_directory")
+        if directory is None or not isinstance(q_table, DenseQTable):
+            return None
+        with self.locked():
+            # Never the goal's current slot, which readers may still be routing from
+            stamps = np.where(directory[:, 0] == goal, np.iinfo(np.int64).max, directory[:, 1])
+            slot = int(stamps.argmin())
+            self.arrays["q_values"][slot] = q_table.values
+            self.arrays["q_visited"][slot] = q_table.visited
+            stamp = int(self.header[HEADER_Q_STAMP]) + 1
+            self.header[HEADER_SEQ] += 1
+            directory[directory[:, 0] == goal, 0] = -1
+            directory[slot] = (goal, stamp)
+            self.header[HEADER_Q_STAMP] = stamp
+            self.header[HEADER_SEQ] += 1
+        table = self._table(slot)
+        self._adopted[goal] = (slot, stamp, table)
+        return table
+
+
+@contextmanager
+def world_write():
+    """Wraps a change to the live environment so other workers see it; a no-op without a shared world."""
+    if shared_world is None:
+        yield
+        return
+    with shared_world.locked():
+        shared_world.pull(env, rl_agent)
+        yield
+        shared_world.push(env)
+
+
+def share_goal_table(goal: int, q_table):
+    """Hands a table just trained for `goal` to the other workers and routes from the shared copy."""
+    if shared_world is None:
+        return
+    with state_lock:
+        table = shared_world.publish_table(goal, q_table)
+        if table is not None:
+            rl_agent.publish(table, goal)
+
+
+@app.middleware("http")
+async def pull_shared_world(request: Request, call_next):
+    # A worker that is busy training keeps its current world until a later request
+    if shared_world is not None and state_lock.acquire(blocking=False):
+        try:
+            shared_world.pull(env, rl_agent)
+        finally:
+            state_lock.release()
+    return await call_next(request)
+
 
 # ============================================================
 # Global State
 # ============================================================
 
-city = CityGraph()
-env = Environment(city.total_nodes)
-rl_agent = QLearningAgent(city, env)
-dijkstra_router = DijkstraRouter(city, env)
-simulation_history: List[dict] = []
+# Training-job pool processes re-import this module only to reach run_training_job,
+# which gets the graph from the pool initializer and the environment from the job;
+# they load no state and never join the shared world. Spawn hands a child its
+# process name before it imports anything, so the name is what marks a job worker.
+JOB_WORKER_NAME = "GreenPathJobWorker"
+IS_JOB_WORKER = multiprocessing.current_process().name.startswith(JOB_WORKER_NAME)
+
+if IS_JOB_WORKER:
+    shared_world = city = env = route_cache = rl_agent = dijkstra_router = simulation_history = fleet = None
+else:
+    shared_world = SharedWorld.open(SHARED_WORLD, load_graph) if SHARED_WORLD else None
+    city = shared_world.graph if shared_world is not None else load_graph()
+    env = Environment(city)
+    route_cache = RouteCache()
+    rl_agent = QLearningAgent(city, env, q_backend=default_q_backend(city), cache=route_cache)
+    # Tables are only worth restoring along with the conditions they were trained for
+    if STATE_DIR and env.restore(os.path.join(STATE_DIR, "environment")) and rl_agent.q_backend == "dense":
+        load_q_tables(rl_agent, STATE_DIR)
+    dijkstra_router = DijkstraRouter(city, env, cache=route_cache)
+    simulation_history = load_history()
+    fleet = Fleet.generate(FLEET_SIZE, city)
+# Guards env/rl_agent mutation and history appends across request threads
+state_lock = threading.RLock()
+if shared_world is not None:
+    shared_world.start(env, rl_agent)
 
 
 # ============================================================
 # Request/Response Models
 # ============================================================
 
-class SimulationParams(BaseModel):
-    start_node: int = Field(..., ge=0, le=63, description="Start node (0-63)")
-    goal_node: int = Field(..., ge=0, le=63, description="Goal node (0-63)")
+def check_node(node: Optional[int]) -> Optional[int]:
+    """Maps a node id from a request to the graph's node index."""
+    if node is None:
+        return None
+    index = city.node_index(node)
+    if index < 0:
+        raise ValueError(f"node {node} is not in the graph")
+    return index
+
+
+def snap_location(model: BaseModel, node_field: str, point_field: str):
+    """Fills in `node_field` with the node nearest `point_field`; exactly one of the two must be given."""
+    node, point = getattr(model, node_field), getattr(model, point_field)
+    if (node is None) == (point is None):
+        raise ValueError(f"give exactly one of {node_field} and {point_field}")
+    if node is None:
+        nearest, _ = city.spatial.nearest([(point.x, point.y)])
+        if nearest[0] < 0:
+            raise ValueError(f"{point_field}: the graph has no nodes")
+        setattr(model, node_field, int(nearest[0]))
+
+
+def labelled_route(graph: CityGraph, route: dict) -> dict:
+    """`route` with the node ids requests use; a copy, since routes may be cached."""
+    if graph.node_ids is None:
+        return route
+    steps = route.get("steps", [])
+    labels = graph.node_labels([step["node"] for step in steps])
+    return {
+        **route,
+        "path": graph.node_labels(route["path"]),
+        "steps": [{**step, "node": label} for step, label in zip(steps, labels)],
+    }
+
+
+def labelled_params(graph: CityGraph, params: BaseModel) -> dict:
+    """params.model_dump() with its *_node fields mapped back to the ids the request used."""
+    dump = params.model_dump()
+    for name, node in dump.items():
+        if name.endswith("_node") and node is not None:
+            dump[name] = graph.node_labels([node])[0]
+    return dump
+
+
+def labelled_vehicles(listing: List[dict]) -> List[dict]:
+    """Fleet.to_list() entries with their locations as request node ids."""
+    for entry, label in zip(listing, city.node_labels([entry["location"] for entry in listing])):
+        entry["location"] = label
+    return listing
+
+
+class Point(BaseModel):
+    x: float = Field(..., allow_inf_nan=False, description="metres")
+    y: float = Field(..., allow_inf_nan=False, description="metres")
+
+class NodeModel(BaseModel):
+    """Base for request models that name graph nodes.
+
+    After field validation every field in NODES is mapped to a node index by
+    check_node; a field paired with a point field is then filled in from the
+    point by snap_location, and exactly one of the two must be given.
+    """
+
+    # node field -> point field that may stand in for it, or None
+    NODES: ClassVar[Dict[str, Optional[str]]] = {}
+
+    @model_validator(mode="after")
+    def resolve_nodes(self) -> "NodeModel":
+        for node_field, point_field in self.NODES.items():
+            try:
+                setattr(self, node_field, check_node(getattr(self, node_field)))
+            except ValueError as exc:
+                raise ValueError(f"{node_field}: {exc}") from None
+            if point_field is not None:
+                snap_location(self, node_field, point_field)
+        return self
+
+class SimulationParams(NodeModel):
+    NODES = {"start_node": "start_point", "goal_node": "goal_point"}
+
+    start_node: Optional[int] = Field(default=None, ge=0, description="Start node id")
+    goal_node: Optional[int] = Field(default=None, ge=0, description="Goal node id")
+    start_point: Optional[Point] = Field(default=None, description="Start location, snapped to the nearest node")
+    goal_point: Optional[Point] = Field(default=None, description="Goal location, snapped to the nearest node")
     vehicle_type: str = Field(default="ev", pattern="^(ev|petrol|hybrid)$")
     priority: str = Field(default="standard", pattern="^(critical|high|standard|low)$")
     traffic_intensity: float = Field(default=0.5, ge=0, le=1)
     rain_level: float = Field(default=0.0, ge=0, le=1)
     episodes: int = Field(default=200, ge=10, le=1000)
+    batch_size: int = Field(default=256, ge=1, le=1000, description="Episodes trained in lockstep (1 = sequential)")
+    routing_algorithm: str = Field(default="dijkstra", pattern="^(dijkstra|astar|bidirectional|incremental|table|time_dependent)$")
+    scenario: Optional[str] = Field(default=None, description="Run in this scenario; its conditions replace rain_level")
+    training_mode: str = Field(
+        default="episodes", pattern="^(episodes|planner)$",
+        description="planner solves the known reward model directly; episodes is ignored"
+    )
+
+class RouteRequest(NodeModel):
+    NODES = {"start_node": "start_point", "goal_node": "goal_point"}
+
+    start_node: Optional[int] = Field(default=None, ge=0, description="Start node id")
+    goal_node: Optional[int] = Field(default=None, ge=0, description="Goal node id")
+    start_point: Optional[Point] = Field(default=None, description="Start location, snapped to the nearest node")
+    goal_point: Optional[Point] = Field(default=None, description="Goal location, snapped to the nearest node")
+    vehicle_type: str = Field(default="ev", pattern="^(ev|petrol|hybrid)$")
+    priority: str = Field(default="standard", pattern="^(critical|high|standard|low)$")
+
+class BatchRouteParams(BaseModel):
+    pairs: List[RouteRequest] = Field(..., min_length=1, max_length=5000)
+    include_rl: bool = Field(default=True, description="Also evaluate routes from the current Q-table (no retraining)")
+    compact: bool = Field(default=False, description="Return path and totals only, without per-step details")
+
+class RoadOverride(BaseModel):
+    from_node: int = Field(..., ge=0)
+    to_node: int = Field(..., ge=0)
+    traffic: float = Field(..., ge=0.1, le=2.0)
+
+class ScenarioParams(BaseModel):
+    rain_level: Optional[float] = Field(default=None, ge=0, le=1, description="Omit to follow the live rain level")
+    flood_zones: Optional[List[int]] = Field(default=None, description="Omit to follow the live flood zones")
+    traffic_scale: float = Field(default=1.0, ge=0.1, le=10, description="Multiplier on live traffic")
+    road_overrides: List[RoadOverride] = Field(default_factory=list, max_length=10000)
+
+class VehicleSpec(NodeModel):
+    NODES = {"location": None}
+
+    id: str
+    type: str = Field(default="ev", pattern="^(ev|petrol|hybrid)$")
+    location: int = Field(..., ge=0)
+    current_range: float = Field(default=300, ge=0, description="km")
+    max_range: Optional[float] = Field(default=None, gt=0, description="km; defaults to current_range")
+    status: str = Field(default="idle", pattern="^(idle|en-route|charging)$")
+    stress_index: float = Field(default=0, ge=0, le=10)
+
+class FleetParams(BaseModel):
+    vehicles: List[VehicleSpec] = Field(..., max_length=20000)
+
+class ChaosParams(BaseModel):
+    center: Point
+    radius: float = Field(default=250.0, gt=0, allow_inf_nan=False, description="metres; every node this close floods")
+
+class DispatchJob(NodeModel):
+    NODES = {"pickup_node": "pickup_point", "dropoff_node": "dropoff_point"}
+
+    id: Optional[str] = None
+    pickup_node: Optional[int] = Field(default=None, ge=0)
+    dropoff_node: Optional[int] = Field(default=None, ge=0)
+    pickup_point: Optional[Point] = None
+    dropoff_point: Optional[Point] = None
+    priority: str = Field(default="standard", pattern="^(critical|high|standard|low)$")
+
+class DispatchParams(BaseModel):
+    jobs: List[DispatchJob] = Field(..., min_length=1, max_length=10000)
 
 class RouteStep(BaseModel):
     node: int
@@ -457,6 +3469,239 @@ class RouteResponse(BaseModel):
     total_distance: float
     co2_emissions: float
     algorithm: str
+    nodes_settled: Optional[int] = None
+
+
+# ============================================================
+# Route Optimization
+# ============================================================
+
+def apply_overrides(environment: Environment, params: SimulationParams):
+    flood_zones = None
+    if params.rain_level > 0.8:
+        flood_zones = {random.randint(0, environment.total_nodes - 1) for _ in range(random.randint(0, 2))}
+    environment.set_conditions(rain=params.rain_level, flood_zones=flood_zones)
+
+
+def iter_optimization(agent: QLearningAgent, router: DijkstraRouter, params: SimulationParams):
+    """Generator pipeline behind /route/optimize.
+
+    Yields ("progress", stats) after every training chunk, then a final
+    ("result", (response, rewards)) with both routes and the full reward history.
+    """
+    rewards: List[float] = []
+    start_time = time.time()
+    warm_start = agent.select_goal(params.goal_node)
+    if params.training_mode == "planner":
+        plan = agent.plan(params.start_node, params.goal_node, params.vehicle_type, params.priority)
+        # The planned return from the start stands in for an episode reward
+        rewards.append(plan["start_value"])
+        yield "progress", {
+            "sweeps": plan["sweeps"],
+            "start_value": plan["start_value"],
+            "elapsed_ms": round((time.time() - start_time) * 1000, 1),
+        }
+    else:
+        for chunk in agent.iter_train(
+            params.start_node, params.goal_node,
+            params.vehicle_type, params.priority,
+            params.episodes, params.batch_size, early_stop=True, status=warm_start
+        ):
+            rewards.extend(chunk)
+            yield "progress", {
+                "episodes_done": len(rewards),
+                "episodes": params.episodes,
+                "mean_reward": sum(chunk) / len(chunk),
+                "min_reward": min(chunk),
+                "max_reward": max(chunk),
+                "elapsed_ms": round((time.time() - start_time) * 1000, 1),
+            }
+    training_time = time.time() - start_time
+
+    # Get routes from both algorithms
+    rl_result = agent.find_route(params.start_node, params.goal_node, params.vehicle_type)
+    dijkstra_result = router.find_route(
+        params.start_node, params.goal_node, params.vehicle_type, params.priority,
+        params.routing_algorithm
+    )
+
+    response = {
+        "rl": labelled_route(router.graph, rl_result),
+        "dijkstra": labelled_route(router.graph, dijkstra_result),
+        "training_time_ms": round(training_time * 1000, 1),
+        "reward_history": rewards[-20:],  # Last 20 episode rewards
+        "warm_start": warm_start,
+        "episodes_requested": params.episodes,
+        "episodes_spent": len(rewards) if params.training_mode == "episodes" else 0,
+    }
+    yield "result", (response, rewards)
+
+
+def run_optimization(agent: QLearningAgent, router: DijkstraRouter, params: SimulationParams):
+    """Trains `agent` and returns the /route/optimize payload plus the full reward history."""
+    for kind, payload in iter_optimization(agent, router, params):
+        if kind == "result":
+            return payload
+
+
+def record_run(params: SimulationParams, response: dict, rewards: List[float]):
+    run_record = {
+        "timestamp": time.time(),
+        "params": labelled_params(city, params),
+        "rl": response["rl"],
+        "dijkstra": response["dijkstra"],
+        "training_time_ms": response["training_time_ms"],
+        "training_episodes": response["episodes_spent"],
+        "final_reward": rewards[-1] if rewards else 0,
+    }
+    simulation_history.append(run_record)
+
+
+# ============================================================
+# Scenarios
+# ============================================================
+
+MAX_SCENARIOS = 1000
+
+scenarios: Dict[str, ScenarioEnvironment] = {}
+scenarios_lock = threading.Lock()
+
+
+def get_scenario(name: str) -> ScenarioEnvironment:
+    with scenarios_lock:
+        scenario = scenarios.get(name)
+    if scenario is None:
+        raise HTTPException(status_code=404, detail=f"Scenario not found: {name}")
+    return scenario
+
+
+def scenario_summary(name: str, scenario: ScenarioEnvironment) -> dict:
+    return {
+        "name": name,
+        "version": scenario.version,
+        "rain_level": round(scenario.rain, 3),
+        "follows_live_rain": scenario._rain is None,
+        "flood_zones": city.node_labels(sorted(scenario.flood_zones)),
+        "follows_live_floods": scenario._flood_zones is None,
+        "traffic_scale": scenario.traffic_scale,
+        "overridden_roads": len(scenario.traffic_overrides),
+    }
+
+
+def scenario_agent(environment: Environment, goal: int) -> QLearningAgent:
+    """A private agent on `environment`, starting from a copy of the shared table for `goal`.
+
+    It feeds the shared replay buffer, which only ever gains transitions.
+    """
+    with state_lock:
+        source, q_table = rl_agent.snapshot_for(goal)
+    agent = QLearningAgent(city, environment, q_backend=rl_agent.q_backend)
+    agent.publish(q_table, source)
+    agent.replay = rl_agent.replay
+    return agent
+
+
+# ============================================================
+# Training Jobs
+# ============================================================
+
+MAX_TRACKED_JOBS = 1000
+
+training_jobs: "OrderedDict[str, dict]" = OrderedDict()
+running_futures: Dict[str, Future] = {}
+jobs_lock = threading.Lock()
+_job_pool: Optional[ProcessPoolExecutor] = None
+# The graph a job worker trains on, sent once by the pool initializer rather than with every job
+_worker_graph: Optional[CityGraph] = None
+
+
+class JobWorkerProcess(multiprocessing.context.SpawnProcess):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = f"{JOB_WORKER_NAME}-{self.name}"
+
+
+class JobWorkerContext(multiprocessing.context.SpawnContext):
+    Process = JobWorkerProcess
+
+
+def init_job_worker(graph: CityGraph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def get_job_pool() -> ProcessPoolExecutor:
+    global _job_pool
+    with jobs_lock:
+        if _job_pool is None:
+            _job_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=JobWorkerContext(),
+                initializer=init_job_worker,
+                initargs=(city,),
+            )
+        return _job_pool
+
+
+def run_training_job(
+    environment: Environment, q_table, q_backend: str, params: SimulationParams,
+    source_goal: Optional[int] = None, replay: Optional[tuple] = None
+):
+    """Worker entry point: trains on a private snapshot and ships back the learned Q-table.
+
+    The snapshot and table arrive without their graph; the worker's own copy is
+    attached here. Transitions recorded during the run come back too, for the
+    parent's replay buffer.
+    """
+    graph = _worker_graph
+    environment.graph = q_table.graph = graph
+    agent = QLearningAgent(graph, environment, q_backend=q_backend)
+    agent.publish(q_table, source_goal)
+    if replay is not None and agent.replay is not None:
+        agent.replay.add(*replay)
+    added = agent.replay.added if agent.replay is not None else 0
+    if params.scenario is None:
+        apply_overrides(environment, params)
+    response, rewards = run_optimization(agent, DijkstraRouter(graph, environment), params)
+    q_table = agent.q_table
+    # The parent already holds the graph; don't pickle it back
+    q_table.graph = None
+    new_transitions = agent.replay.contents(agent.replay.added - added) if agent.replay is not None else None
+    return response, rewards, q_table, new_transitions
+
+
+def _finish_job(job: dict, params: SimulationParams, future: Future):
+    try:
+        response, rewards, q_table, new_transitions = future.result()
+    except Exception as exc:
+        with jobs_lock:
+            job.update(status="failed", error=repr(exc), finished_at=time.time())
+            running_futures.pop(job["id"], None)
+        return
+
+    # Publish the trained table by swapping the reference; the last job to finish wins.
+    # Scenario runs are what-ifs and never publish.
+    q_table.graph = city
+    if new_transitions is not None and rl_agent.replay is not None:
+        rl_agent.replay.add(*new_transitions)
+    if params.scenario is None:
+        with state_lock:
+            rl_agent.publish(q_table, params.goal_node)
+            share_goal_table(params.goal_node, q_table)
+    record_run(params, response, rewards)
+    with jobs_lock:
+        job.update(status="done", result=response, finished_at=time.time())
+        running_futures.pop(job["id"], None)
+
+
+def _evict_finished_jobs():
+    while len(training_jobs) > MAX_TRACKED_JOBS:
+        for job_id, job in training_jobs.items():
+            if job["status"] in ("done", "failed"):
+                del training_jobs[job_id]
+                break
+        else:
+            return
 
 
 # ============================================================
@@ -469,7 +3714,9 @@ def read_root():
         "status": "GreenPath Engine Running",
         "version": "2.0.0",
         "total_nodes": city.total_nodes,
-        "total_edges": len(city.edges),
+        "total_edges": city.num_edges,
+        # Node coordinates span this box (min_x, min_y, max_x, max_y) in metres
+        "bounds": np.concatenate([city.coords.min(axis=0), city.coords.max(axis=0)]).tolist() if city.total_nodes else None,
         "simulation_runs": len(simulation_history)
     }
 
@@ -480,135 +3727,380 @@ def health_check():
         "status": "healthy",
         "uptime_nodes": city.total_nodes,
         "q_table_size": len(rl_agent.q_table),
-        "active_flood_zones": list(env.flood_zones),
+        "active_flood_zones": city.node_labels(sorted(env.flood_zones)),
         "rain_level": round(env.rain, 3)
     }
 
 
 @app.post("/simulate/step")
+@profiled
 def trigger_step():
     """Advances simulation by one time step (traffic, weather)"""
-    env.update()
+    with state_lock:
+        with world_write():
+            env.update()
+    fleet.step()
     return {
         "status": "updated",
         "rain_level": round(env.rain, 3),
-        "flood_zones": list(env.flood_zones)
+        "flood_zones": city.node_labels(sorted(env.flood_zones))
     }
 
 
 @app.post("/route/optimize")
+@profiled
 def optimize_route(params: SimulationParams):
     """Trains the RL agent and returns both RL and Dijkstra routes for comparison"""
     if params.start_node == params.goal_node:
         raise HTTPException(status_code=400, detail="Start and goal nodes must be different")
 
-    # Apply environment overrides
-    env.rain = params.rain_level
-    if params.rain_level > 0.8:
-        env.flood_zones.clear()
-        for _ in range(random.randint(0, 2)):
-            env.flood_zones.add(random.randint(0, city.total_nodes - 1))
+    if params.scenario is not None:
+        # Trains a private copy on a frozen view of the scenario; shared state is untouched
+        env_snapshot = get_scenario(params.scenario).snapshot()
+        agent = scenario_agent(env_snapshot, params.goal_node)
+        response, rewards = run_optimization(agent, DijkstraRouter(city, env_snapshot), params)
+        record_run(params, response, rewards)
+        return InstrumentedJSONResponse(response)
+
+    with state_lock:
+        with world_write():
+            apply_overrides(env, params)
+        response, rewards = run_optimization(rl_agent, dijkstra_router, params)
+        share_goal_table(params.goal_node, rl_agent.q_table)
+        record_run(params, response, rewards)
+    return InstrumentedJSONResponse(response)
 
-    # Train RL agent
+
+@app.post("/route/batch")
+@profiled
+def batch_routes(params: BatchRouteParams):
+    """Routes many origin-destination pairs, sharing one Dijkstra tree per origin and profile"""
     start_time = time.time()
-    rewards = rl_agent.train(
-        params.start_node, params.goal_node,
-        params.vehicle_type, params.priority,
-        params.episodes
-    )
-    training_time = time.time() - start_time
+    groups: Dict[tuple, List[int]] = {}
+    for i, pair in enumerate(params.pairs):
+        groups.setdefault((pair.start_node, pair.vehicle_type, pair.priority), []).append(i)
 
-    # Get routes from both algorithms
-    rl_result = rl_agent.find_route(params.start_node, params.goal_node, params.vehicle_type)
-    dijkstra_result = dijkstra_router.find_route(
-        params.start_node, params.goal_node, params.vehicle_type, params.priority
-    )
+    routes: List[Optional[dict]] = [None] * len(params.pairs)
+    for (start, vehicle_type, priority), indices in groups.items():
+        goals = [params.pairs[i].goal_node for i in indices]
+        for i, result in zip(indices, dijkstra_router.find_routes_from(start, goals, vehicle_type, priority)):
+            pair = params.pairs[i]
+            start_label, goal_label = city.node_labels([pair.start_node, pair.goal_node])
+            route = {
+                "start_node": start_label,
+                "goal_node": goal_label,
+                "vehicle_type": pair.vehicle_type,
+                "priority": pair.priority,
+                "dijkstra": labelled_route(city, result),
+            }
+            if params.include_rl:
+                route["rl"] = labelled_route(city, rl_agent.find_route(pair.start_node, pair.goal_node, pair.vehicle_type))
+            if params.compact:
+                for key in ("dijkstra", "rl"):
+                    if key in route:
+                        route[key] = {k: v for k, v in route[key].items() if k != "steps"}
+            routes[i] = route
 
-    # Save to history
-    run_record = {
-        "id": len(simulation_history) + 1,
-        "timestamp": time.time(),
-        "params": params.model_dump(),
-        "rl": rl_result,
-        "dijkstra": dijkstra_result,
-        "training_time_ms": round(training_time * 1000, 1),
-        "training_episodes": params.episodes,
-        "final_reward": rewards[-1] if rewards else 0,
-    }
-    simulation_history.append(run_record)
+    return InstrumentedJSONResponse({
+        "routes": routes,
+        "sources": len(groups),
+        "elapsed_ms": round((time.time() - start_time) * 1000, 1),
+    })
 
-    return {
-        "rl": rl_result,
-        "dijkstra": dijkstra_result,
-        "training_time_ms": round(training_time * 1000, 1),
-        "reward_history": rewards[-20:],  # Last 20 episode rewards
+
+@app.post("/route/optimize/stream")
+def optimize_route_stream(params: SimulationParams):
+    """Streams training progress as Server-Sent Events, then the final routes.
+
+    Training runs on a snapshot of the environment and Q-table. Disconnecting
+    stops training at the next batch; only completed runs publish their Q-table.
+    """
+    if params.start_node == params.goal_node:
+        raise HTTPException(status_code=400, detail="Start and goal nodes must be different")
+
+    if params.scenario is not None:
+        env_snapshot = get_scenario(params.scenario).snapshot()
+    else:
+        with state_lock:
+            env_snapshot = env.snapshot()
+        apply_overrides(env_snapshot, params)
+    agent = scenario_agent(env_snapshot, params.goal_node)
+
+    def events():
+        for kind, payload in iter_optimization(agent, DijkstraRouter(city, env_snapshot), params):
+            if kind == "result":
+                response, rewards = payload
+                if params.scenario is None:
+                    with state_lock:
+                        rl_agent.publish(agent.q_table, params.goal_node)
+                        share_goal_table(params.goal_node, agent.q_table)
+                record_run(params, response, rewards)
+                payload = response
+            yield f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/jobs/optimize", status_code=202)
+def submit_optimize_job(params: SimulationParams):
+    """Queues a route optimization on the worker pool and returns its job id"""
+    if params.start_node == params.goal_node:
+        raise HTTPException(status_code=400, detail="Start and goal nodes must be different")
+
+    source = get_scenario(params.scenario) if params.scenario is not None else env
+    with state_lock:
+        env_snapshot = source.snapshot()
+        source_goal, q_snapshot = rl_agent.snapshot_for(params.goal_node)
+    replay = rl_agent.replay.contents() if rl_agent.replay is not None else None
+    # Every worker already holds the graph; don't pickle it with each job
+    env_snapshot.graph = q_snapshot.graph = None
+    job_id = uuid.uuid4().hex
+    future = get_job_pool().submit(
+        run_training_job, env_snapshot, q_snapshot, rl_agent.q_backend, params, source_goal, replay
+    )
+    job = {
+        "id": job_id,
+        "status": "queued",
+        "submitted_at": time.time(),
+        "finished_at": None,
+        "params": labelled_params(city, params),
+        "result": None,
+        "error": None,
     }
+    with jobs_lock:
+        training_jobs[job_id] = job
+        running_futures[job_id] = future
+        _evict_finished_jobs()
+    future.add_done_callback(lambda f: _finish_job(job, params, f))
+    return {"job_id": job_id, "status": job["status"]}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """Polls a training job; includes the optimization result once done"""
+    with jobs_lock:
+        job = training_jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        future = running_futures.get(job_id)
+        if job["status"] == "queued" and future is not None and future.running():
+            job["status"] = "running"
+        return dict(job)
 
 
 @app.post("/chaos/trigger")
-def trigger_chaos():
-    """Injects a major incident — floods random nodes and spikes traffic"""
-    affected = []
-    for _ in range(random.randint(2, 5)):
-        node = random.randint(0, city.total_nodes - 1)
-        env.flood_zones.add(node)
-        affected.append(node)
-    env.rain = min(1.0, env.rain + 0.4)
+@profiled
+def trigger_chaos(params: Optional[ChaosParams] = None):
+    """Injects a major incident — floods random nodes, or every node in the given area, and spikes traffic"""
+    if params is not None:
+        _, nodes, _ = city.spatial.within([(params.center.x, params.center.y)], params.radius)
+        affected = sorted(nodes.tolist())
+    else:
+        affected = [random.randint(0, city.total_nodes - 1) for _ in range(random.randint(2, 5))]
+    with state_lock:
+        with world_write():
+            env.set_conditions(rain=min(1.0, env.rain + 0.4), flood_zones=env.flood_zones | set(affected))
 
     return {
         "event": "Major Weather Event Triggered",
         "impact": "Multiple routes blocked, recalculation required",
-        "affected_nodes": affected,
+        "affected_nodes": city.node_labels(affected),
         "new_rain_level": round(env.rain, 3)
     }
 
 
-@app.get("/metrics")
-def get_metrics():
-    total_runs = len(simulation_history)
-    rl_wins = sum(
-        1 for r in simulation_history
-        if r["rl"]["total_fuel"] < r["dijkstra"]["total_fuel"]
-    )
-    avg_training_time = (
-        sum(r["training_time_ms"] for r in simulation_history) / total_runs
-        if total_runs > 0 else 0
+@app.put("/scenarios/{name}")
+def put_scenario(name: str, params: ScenarioParams):
+    """Creates or replaces a named what-if scenario layered over the live environment"""
+    flood_zones = None
+    if params.flood_zones is not None:
+        flood_zones = {city.node_index(node) for node in params.flood_zones}
+        if -1 in flood_zones:
+            missing = next(node for node in params.flood_zones if city.node_index(node) < 0)
+            raise HTTPException(status_code=400, detail=f"Flood zone {missing} is not in the graph")
+    overrides = {}
+    for road in params.road_overrides:
+        u, v = city.node_index(road.from_node), city.node_index(road.to_node)
+        i = city.edge_index(u, v) if u >= 0 and v >= 0 else -1
+        if i < 0:
+            raise HTTPException(status_code=400, detail=f"No road between {road.from_node} and {road.to_node}")
+        overrides[int(city.edge_ids[i])] = road.traffic
+    scenario = ScenarioEnvironment(
+        env, rain=params.rain_level,
+        flood_zones=flood_zones,
+        traffic_scale=params.traffic_scale, traffic_overrides=overrides
     )
+    with scenarios_lock:
+        if name not in scenarios and len(scenarios) >= MAX_SCENARIOS:
+            raise HTTPException(status_code=409, detail=f"Scenario limit reached ({MAX_SCENARIOS})")
+        scenarios[name] = scenario
+    return scenario_summary(name, scenario)
+
+
+@app.get("/scenarios")
+def list_scenarios():
+    with scenarios_lock:
+        items = list(scenarios.items())
+    return {"scenarios": [scenario_summary(name, scenario) for name, scenario in items]}
+
+
+@app.get("/scenarios/{name}")
+def get_scenario_state(name: str):
+    return scenario_summary(name, get_scenario(name))
 
+
+@app.delete("/scenarios/{name}")
+def delete_scenario(name: str):
+    with scenarios_lock:
+        if scenarios.pop(name, None) is None:
+            raise HTTPException(status_code=404, detail=f"Scenario not found: {name}")
+    return {"deleted": name}
+
+
+@app.post("/scenarios/{name}/route")
+def route_in_scenario(
+    name: str, request: RouteRequest,
+    algorithm: str = Query(default="dijkstra", pattern="^(dijkstra|astar|bidirectional|incremental|table|time_dependent)$")
+):
+    """Routes under a scenario's conditions without touching the live environment"""
+    scenario = get_scenario(name)
+    return InstrumentedJSONResponse(labelled_route(city, DijkstraRouter(city, scenario).find_route(
+        request.start_node, request.goal_node, request.vehicle_type, request.priority, algorithm
+    )))
+
+
+@app.get("/metrics")
+def get_metrics():
     return {
-        "total_simulations": total_runs,
-        "rl_wins": rl_wins,
-        "dijkstra_wins": total_runs - rl_wins,
-        "rl_win_rate": round(rl_wins / total_runs * 100, 1) if total_runs > 0 else 0,
-        "avg_training_time_ms": round(avg_training_time, 1),
+        **simulation_history.aggregates(),
         "q_table_states": len(rl_agent.q_table),
         "active_flood_zones": len(env.flood_zones),
-        "current_rain": round(env.rain, 3)
+        "current_rain": round(env.rain, 3),
+        "route_cache": route_cache.stats(),
+        "scenarios": len(scenarios),
+        "goal_tables": len(rl_agent.goal_tables),
+        "replay_transitions": len(rl_agent.replay) if rl_agent.replay is not None else 0,
+    }
+
+
+@app.get("/metrics/prometheus", response_class=PlainTextResponse)
+def get_prometheus_metrics():
+    """Latency histograms, hot-path counters and size gauges in Prometheus text format"""
+    q_table = rl_agent.q_table
+    metrics.set("greenpath_q_table_states", len(q_table), backend=rl_agent.q_backend)
+    metrics.set("greenpath_goal_tables", len(rl_agent.goal_tables))
+    if isinstance(q_table, DenseQTable):
+        tables = list(rl_agent.goal_tables.values()) or [q_table]
+        metrics.set("greenpath_q_table_bytes", sum(t.values.nbytes + t.visited.nbytes for t in tables), backend="dense")
+    if rl_agent.replay is not None:
+        metrics.set("greenpath_replay_transitions", len(rl_agent.replay))
+    cache_stats = route_cache.stats()
+    metrics.set("greenpath_route_cache_entries", cache_stats["entries"])
+    metrics.set("greenpath_route_cache_requests_total", cache_stats["hits"], result="hit")
+    metrics.set("greenpath_route_cache_requests_total", cache_stats["misses"], result="miss")
+    metrics.set("greenpath_simulation_runs", len(simulation_history))
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/profiles")
+def get_profiles():
+    """Sampled cProfile captures of slow requests, newest first"""
+    return {
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "slow_ms": PROFILE_SLOW_MS,
+        "profiles": list(reversed(profiles))
     }
 
 
+@app.post("/state/snapshot")
+def snapshot_state():
+    """Persists the graph and Q-tables so restarted workers start warm"""
+    if not STATE_DIR:
+        raise HTTPException(status_code=400, detail="Persistence disabled; set GREENPATH_STATE_DIR")
+    return save_state(STATE_DIR)
+
+
 @app.get("/history")
-def get_history(limit: int = 20):
-    """Retrieve recent simulation history"""
-    recent = simulation_history[-limit:]
-    recent.reverse()
-    return {"runs": recent, "total": len(simulation_history)}
+def get_history(limit: int = Query(default=20, ge=1, le=500), cursor: Optional[int] = None):
+    """Retrieve recent simulation history, newest first; pass next_cursor to page back"""
+    runs, next_cursor = simulation_history.page(limit, cursor)
+    return {"runs": runs, "total": len(simulation_history), "next_cursor": next_cursor}
 
 
 @app.get("/fleet")
 def get_fleet():
-    """Return simulated fleet status"""
-    fleet = []
-    for i in range(5):
-        fleet.append({
-            "id": f"VH-{100 + i}",
-            "type": "ev" if i % 2 == 0 else "petrol",
-            "location": random.randint(0, city.total_nodes - 1),
-            "status": random.choice(["idle", "en-route", "charging"]),
-            "current_range": random.randint(50, 300),
-            "stress_index": round(random.random() * 10, 1)
-        })
-    return {"fleet": fleet}
+    """Return fleet status"""
+    with fleet.lock:
+        return {"fleet": labelled_vehicles(fleet.to_list())}
+
+
+@app.get("/fleet/nearby")
+def get_nearby_fleet(
+    x: float = Query(..., allow_inf_nan=False, description="metres"),
+    y: float = Query(..., allow_inf_nan=False, description="metres"),
+    radius: float = Query(default=500.0, gt=0, allow_inf_nan=False, description="metres"),
+    status: Optional[str] = Query(default=None, pattern="^(idle|en-route|charging)$"),
+    limit: int = Query(default=20, ge=1, le=1000)
+):
+    """Vehicles parked at nodes within `radius` metres of (x, y), nearest first"""
+    current = fleet
+    vehicles, distances = current.nearby(city.spatial, (x, y), radius)
+    with current.lock:
+        if status is not None:
+            keep = current.status[vehicles] == status
+            vehicles, distances = vehicles[keep], distances[keep]
+        listing = current.to_list(vehicles[:limit])
+    for entry, distance in zip(listing, distances[:limit].tolist()):
+        entry["distance_m"] = round(distance, 1)
+    return {"fleet": labelled_vehicles(listing), "matched": len(vehicles)}
+
+
+@app.put("/fleet")
+def replace_fleet(params: FleetParams):
+    """Replaces the fleet with the given vehicles"""
+    global fleet
+    vehicles = params.vehicles
+    if len({v.id for v in vehicles}) != len(vehicles):
+        raise HTTPException(status_code=400, detail="Vehicle ids must be unique")
+    fleet = Fleet(
+        ids=[v.id for v in vehicles],
+        types=[v.type for v in vehicles],
+        locations=[v.location for v in vehicles],
+        ranges=[v.current_range for v in vehicles],
+        max_ranges=[v.max_range or max(v.current_range, 1.0) for v in vehicles],
+        statuses=[v.status for v in vehicles],
+        stress=[v.stress_index for v in vehicles],
+    )
+    return {"vehicles": len(fleet)}
+
+
+@app.post("/fleet/dispatch")
+@profiled
+def dispatch_jobs(params: DispatchParams):
+    """Assigns a batch of delivery jobs to idle vehicles at least total routing cost"""
+    start_time = time.time()
+    jobs = params.jobs
+    current = fleet
+    vehicle, cost, km, feasible = current.dispatch(
+        dijkstra_router,
+        np.array([j.pickup_node for j in jobs], dtype=np.int64),
+        np.array([j.dropoff_node for j in jobs], dtype=np.int64),
+        np.array([j.priority for j in jobs], dtype=object),
+    )
+    assignments = []
+    for i, job in enumerate(jobs):
+        entry = {"job_id": job.id if job.id is not None else str(i), "vehicle_id": None}
+        if vehicle[i] >= 0:
+            entry.update(vehicle_id=current.ids[vehicle[i]], cost=round(float(cost[i]), 5), distance_km=round(float(km[i]), 3))
+        else:
+            entry["reason"] = "no idle vehicle left" if feasible[i] else "unreachable or out of range"
+        assignments.append(entry)
+    return {
+        "assignments": assignments,
+        "assigned": int((vehicle >= 0).sum()),
+        "unassigned": int((vehicle < 0).sum()),
+        "elapsed_ms": round((time.time() - start_time) * 1000, 1),
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+"""solve_assignment against brute force on small dispatch-sized instances."""
+
+import itertools
+
+import numpy as np
+import pytest
+
+from main import solve_assignment
+
+
+def brute_force(cost: np.ndarray) -> tuple:
+    """(rows matched, total cost) of the best matching: most rows first, then least cost."""
+    rows, cols = cost.shape
+    best = (0, 0.0)
+    for choice in itertools.product(range(-1, cols), repeat=rows):
+        used = [c for c in choice if c >= 0]
+        if len(used) != len(set(used)) or any(c >= 0 and np.isinf(cost[r, c]) for r, c in enumerate(choice)):
+            continue
+        total = sum(cost[r, c] for r, c in enumerate(choice) if c >= 0)
+        if len(used) > best[0] or (len(used) == best[0] and total < best[1]):
+            best = (len(used), total)
+    return best
+
+
+def matched(cost: np.ndarray, result: np.ndarray) -> tuple:
+    """Checks `result` is a valid matching and returns its (rows matched, total cost)."""
+    picked = result[result >= 0]
+    assert len(np.unique(picked)) == len(picked)
+    rows = np.nonzero(result >= 0)[0]
+    assert np.isfinite(cost[rows, picked]).all()
+    return len(picked), float(cost[rows, picked].sum())
+
+
+def tolerance(cost: np.ndarray) -> float:
+    # The auction stops at an epsilon that bounds the total's excess by 1e-3 of the cost spread
+    finite = cost[np.isfinite(cost)]
+    return 1e-3 * float(finite.max() - finite.min()) + 1e-9 if len(finite) else 0.0
+
+
+def instances(seed: int, count: int, forbidden: float):
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        rows, cols = rng.integers(1, 6, size=2)
+        cost = rng.random((rows, cols)) * rng.choice([1.0, 100.0, 1e4])
+        yield np.where(rng.random((rows, cols)) < forbidden, np.inf, cost)
+
+
+@pytest.mark.parametrize("forbidden", [0.0, 0.3, 0.6])
+def test_matches_brute_force_optimum(forbidden):
+    for cost in instances(1, 150, forbidden):
+        count, total = matched(cost, solve_assignment(cost))
+        best_count, best_total = brute_force(cost)
+        assert count == best_count
+        assert total == pytest.approx(best_total, abs=tolerance(cost))
+
+
+@pytest.mark.parametrize("candidates", [1, 2])
+def test_candidate_cap_still_matches_every_row_it_can(candidates):
+    # Rows that lose their capped candidates are retried against the columns still free
+    for cost in instances(2, 150, 0.0):
+        count, total = matched(cost, solve_assignment(cost, candidates))
+        best_count, best_total = brute_force(cost)
+        assert count == best_count == min(cost.shape)
+        assert total >= best_total - tolerance(cost)
+
+
+def test_candidate_cap_contended_columns():
+    # Every row's two cheapest columns are the same two, so most rows fall back to later rounds
+    cost = np.array([[1.0, 2.0, 50.0, 60.0, 70.0]] * 4) + np.arange(4)[:, None] * 0.1
+    count, _ = matched(cost, solve_assignment(cost, candidates=2))
+    assert count == 4